@@ -0,0 +1,79 @@
+import time
+import asyncio
+import logging
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from . import db
+from . import metrics
+from . import tracing
+from .setting import Setting
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_WORKERS = 5
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        setting = Setting.get_instance()
+        workers = int(setting.get("db_executor_workers", DEFAULT_WORKERS))
+        _executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="db")
+        logger.info("Started DB executor with {} workers.".format(workers))
+
+    return _executor
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+
+    _executor = None
+
+async def run(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a blocking DB operation in the DB thread pool.
+
+    The operation runs in its own `db.session_scope()` unless `session`
+    is given, so concurrent tasks never share one.
+
+    Args:
+        func (Callable[..., Any]):
+            Function of lib.operations taking a `session` keyword.
+    Returns:
+        Any:
+            Return value of func.
+    """
+    name = getattr(func, "__name__", "unknown")
+    # callers pass their optional session through, None included
+    given = kwargs.pop("session", None)
+
+    def call():
+        if given is not None:
+            return func(*args, session=given, **kwargs)
+
+        with db.session_scope() as session:
+            return func(*args, session=session, **kwargs)
+
+    def task():
+        start = time.perf_counter()
+        try:
+            return call()
+
+        except Exception:
+            metrics.db_failures.labels(name).inc()
+            raise
+
+        finally:
+            metrics.db_seconds.labels(name).observe(time.perf_counter() - start)
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+
+    with tracing.tracer.span("db", operation=name):
+        return await loop.run_in_executor(
+            get_executor(), functools.partial(context.run, task))
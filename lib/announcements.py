@@ -0,0 +1,74 @@
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAXSIZE = 1024
+DEFAULT_TTL = 172800 # seconds
+
+
+class Announcement(object):
+    """Go-live messages of one stream, to be edited on later events."""
+
+    def __init__(
+        self, user_name, stream_id, title, game_id, content, embed, messages,
+    ):
+        self.user_name = user_name
+        self.stream_id = stream_id
+        self.title = title
+        self.game_id = game_id
+        self.content = content
+        self.embed = embed
+        self.messages = messages
+        self.created = time.monotonic()
+
+
+class AnnouncementStore(object):
+    """Announcements of live streams by Twitch UserID.
+
+    Entries are removed when the stream ends, and bounded by LRU eviction
+    and a TTL in case the offline event never arrives.
+
+    Args:
+        maxsize (int):
+            Max number of live streams to remember.
+        ttl (float):
+            Seconds to keep an announcement.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE, ttl: float = DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._announcements = OrderedDict()
+
+    def __len__(self):
+        return len(self._announcements)
+
+    def add(self, user_id, announcement: Announcement) -> None:
+        user_id = str(user_id)
+        self._announcements[user_id] = announcement
+        self._announcements.move_to_end(user_id)
+        while len(self._announcements) > self.maxsize:
+            self._announcements.popitem(last=False)
+
+    def get(self, user_id) -> Optional[Announcement]:
+        announcement = self._announcements.get(str(user_id), None)
+        if announcement is None:
+            return None
+
+        if time.monotonic() - announcement.created > self.ttl:
+            del self._announcements[str(user_id)]
+            return None
+
+        return announcement
+
+    def pop(self, user_id) -> Optional[Announcement]:
+        announcement = self.get(user_id)
+        self._announcements.pop(str(user_id), None)
+
+        return announcement
+
+
+store = AnnouncementStore()
@@ -0,0 +1,155 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Optional
+
+import aiohttp
+
+from .setting import Setting
+
+
+logger = logging.getLogger(__name__)
+TOKEN_URL = "https://id.twitch.tv/oauth2/token"
+DEFAULT_REFRESH_MARGIN = 3600 # seconds
+DEFAULT_FAILURE_BACKOFF = 60 # seconds
+
+
+class AppToken(object):
+    """OAuth app access token of the client credentials flow.
+
+    The token is cached until `margin` seconds before it expires. Concurrent
+    callers needing a new one share a single token request. Without a
+    client secret in the settings no token is requested and Helix calls
+    go out with the Client-ID only, as before. After a failed token request
+    no other is made for `backoff` seconds.
+
+    Args:
+        margin (float):
+            Seconds before expiry to get a new token.
+        backoff (float):
+            Seconds to wait after a failed token request.
+    """
+
+    def __init__(
+        self,
+        margin: float = DEFAULT_REFRESH_MARGIN,
+        backoff: float = DEFAULT_FAILURE_BACKOFF,
+    ):
+        self.margin = margin
+        self.backoff = backoff
+        self.fetched = 0
+        self.failed = 0
+        self.invalidated = 0
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._retry_at = 0.0
+        self._inflight: Optional[asyncio.Future] = None
+
+    @property
+    def enabled(self) -> bool:
+        setting = Setting.get_instance()
+
+        return bool(setting.get("twitch_client_secret", None))
+
+    async def get(self, session: aiohttp.ClientSession) -> Optional[str]:
+        """Get a valid token, requesting one when needed.
+
+        Args:
+            session (aiohttp.ClientSession):
+                Session to request the token with.
+        Returns:
+            Optional[str]:
+                Access token. None without a client secret or when the
+                token request failed.
+        """
+        if not self.enabled:
+            return None
+
+        if self._token is not None and time.monotonic() < self._refresh_at:
+            return self._token
+
+        if time.monotonic() < self._retry_at:
+            # the last request failed, do not hammer the token endpoint
+            return self._current()
+
+        if self._inflight is not None:
+            return await asyncio.shield(self._inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight = future
+        try:
+            token = await self._fetch(session)
+
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        except Exception as ex:
+            logger.exception(ex)
+            self.failed += 1
+            token = None
+
+        finally:
+            self._inflight = None
+
+        if token is None:
+            self._retry_at = time.monotonic() + self.backoff
+            # keep using the current token until it really expires
+            token = self._current()
+
+        future.set_result(token)
+
+        return token
+
+    def _current(self) -> Optional[str]:
+        if time.monotonic() < self._expires_at:
+            return self._token
+
+        return None
+
+    async def _fetch(self, session: aiohttp.ClientSession) -> Optional[str]:
+        setting = Setting.get_instance()
+        async with session.post(TOKEN_URL, params={
+            "client_id": setting["twitch_client_id"],
+            "client_secret": setting["twitch_client_secret"],
+            "grant_type": "client_credentials",
+        }) as resp:
+            json_body = await resp.json()
+            if resp.status != 200 or "access_token" not in json_body:
+                logger.error("Failed to get app access token: {}".format(
+                    json_body.get("message", resp.status)))
+                self.failed += 1
+                return None
+
+        now = time.monotonic()
+        expires_in = float(json_body.get("expires_in", 0))
+        self._token = json_body["access_token"]
+        self._expires_at = now + expires_in
+        # short lived tokens are refreshed halfway
+        self._refresh_at = now + max(expires_in - self.margin, expires_in / 2)
+        self.fetched += 1
+        logger.info("Got app access token, expires in {}s.".format(
+            json_body.get("expires_in", 0)))
+
+        return self._token
+
+    def invalidate(self, token: str) -> None:
+        """Drop a token Twitch refused, unless it was already replaced."""
+        if token is not None and token == self._token:
+            self._token = None
+            self._expires_at = 0.0
+            self._refresh_at = 0.0
+            self.invalidated += 1
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "expires_in": max(self._expires_at - time.monotonic(), 0.0),
+            "fetched": self.fetched,
+            "failed": self.failed,
+            "invalidated": self.invalidated,
+        }
+
+
+app_token = AppToken()
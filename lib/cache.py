@@ -0,0 +1,131 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTTLCache(object):
+    """Bounded LRU cache with TTL for async loaders.
+
+    Concurrent lookups of the same missing key share a single in-flight
+    load. Loaders returning None are not cached.
+
+    Args:
+        maxsize (int):
+            Max number of entries. Least recently used entries are evicted.
+        ttl (float):
+            Seconds until an entry expires.
+    """
+
+    def __init__(self, maxsize: int = 512, ttl: float = 86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._data = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._data.get(key, None)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            return default
+
+        return entry[1]
+
+    def set(self, key, value) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        """Get a cached value, or load it once for all concurrent callers.
+
+        Args:
+            key (Hashable):
+                Cache key.
+            loader (Callable[[], Awaitable[Any]]):
+                Coroutine function called on a miss.
+        Returns:
+            Any:
+                Cached or loaded value.
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        future = self._inflight.get(key, None)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        except Exception as ex:
+            future.set_exception(ex)
+            # retrieve exception so it is not reported as never retrieved
+            future.exception()
+            raise
+
+        else:
+            if value is not None:
+                self.set(key, value)
+
+            future.set_result(value)
+
+        finally:
+            del self._inflight[key]
+
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -1,8 +1,19 @@
 import os
+import time
+import logging
+from threading import Lock
+from contextlib import contextmanager
+from typing import Dict
+
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
+from .setting import Setting
+
+logger = logging.getLogger(__name__)
+
 DB_FILENAME = "shachiku.db"
 if os.environ.get("DATABASE_URL", None) is not None:
     RDB_PATH = os.environ["DATABASE_URL"]
@@ -10,9 +21,103 @@ else:
     RDB_PATH = "postgresql:///{}".format(DB_FILENAME)
 
 ECHO_LOG = False
+# setting key -> (environment variable, default, type)
+POOL_OPTIONS = {
+    "db_pool_size": ("DB_POOL_SIZE", 5, int),
+    "db_max_overflow": ("DB_MAX_OVERFLOW", 10, int),
+    "db_pool_timeout": ("DB_POOL_TIMEOUT", 30, float),
+    "db_pool_recycle": ("DB_POOL_RECYCLE", 1800, int),
+    "db_pool_pre_ping": ("DB_POOL_PRE_PING", True, lambda v: str(v).lower() in ("1", "true", "yes")),
+}
+
+
+class PoolMetrics(object):
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, wait: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+def _pool_options(setting=None) -> Dict:
+    if RDB_PATH.startswith("sqlite"):
+        return {}
+
+    options = dict()
+    for key, (environ, default, cast) in POOL_OPTIONS.items():
+        value = setting.get(key, None) if setting is not None else None
+        if value is None:
+            value = os.environ.get(environ, default)
+
+        options[key[len("db_"):]] = cast(value)
+
+    return options
+
+def _create_engine(setting=None):
+    return create_engine(RDB_PATH, echo=ECHO_LOG, **_pool_options(setting))
 
 Base = declarative_base()
-engine = create_engine(RDB_PATH, echo=ECHO_LOG)
+engine = _create_engine()
+
+Session = scoped_session(sessionmaker(bind=engine))
+# default session of lib.operations, one per thread
+session = Session
+metrics = PoolMetrics()
+
+def configure_engine(setting: Setting = None) -> None:
+    """Recreate the engine with pool options from settings.
+
+    Options missing from settings are read from environment variables.
+    """
+    global engine
+    setting = setting or Setting.get_instance()
+    Session.remove()
+    engine.dispose()
+    engine = _create_engine(setting)
+    Session.configure(bind=engine)
+    logger.info("DB engine configured: {}".format(_pool_options(setting)))
+
+@contextmanager
+def session_scope():
+    """Unit of work on a session of its own.
+
+    Commits on success, rolls back on error and releases the session and
+    its connection on exit.
+    """
+    session = Session()
+    try:
+        start = time.perf_counter()
+        session.connection()
+        metrics.record_wait(time.perf_counter() - start)
+
+        yield session
+        session.commit()
+
+    except Exception:
+        session.rollback()
+        raise
+
+    finally:
+        Session.remove()
+
+def pool_stats() -> Dict[str, float]:
+    """Connection pool usage for monitoring."""
+    pool = engine.pool
+    # SingletonThreadPool of SQLite has an int size and no overflow
+    queued = isinstance(pool, QueuePool)
+    stats = {
+        "size": pool.size() if queued else 0,
+        "checked_out": pool.checkedout() if queued else 0,
+        "overflow": pool.overflow() if queued else 0,
+        "checkouts": metrics.checkouts,
+        "avg_wait": metrics.total_wait / metrics.checkouts if metrics.checkouts else 0.0,
+        "max_wait": metrics.max_wait,
+    }
 
-Session = sessionmaker(bind=engine)
-session = Session()
+    return stats
@@ -0,0 +1,206 @@
+import time
+import asyncio
+import functools
+import logging
+from typing import Dict, List, Optional
+
+import discord
+
+from .setting import Setting
+from . import metrics
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_CONCURRENCY = 20
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_AFTER = 1.0 # seconds
+
+
+def _percentile(values: List[float], percent: float) -> Optional[float]:
+    if len(values) == 0:
+        return None
+
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+
+    return ordered[index]
+
+def _retry_after(ex: discord.HTTPException) -> float:
+    response = getattr(ex, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for key in ("Retry-After", "X-RateLimit-Reset-After"):
+        value = headers.get(key, None)
+        if value is not None:
+            try:
+                return float(value)
+
+            except ValueError:
+                pass
+
+    return DEFAULT_RETRY_AFTER
+
+
+class FanoutDispatcher(object):
+    """Send one message to many Discord channels concurrently.
+
+    Sends are bounded by a semaphore and serialized per channel, which is
+    the rate-limit bucket of Discord's create-message route. A 429 blocks
+    its bucket for the advised delay before the send is retried.
+
+    Args:
+        concurrency (int):
+            Max number of sends in flight.
+        max_retries (int):
+            Max retries of a rate-limited send.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+    ):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._loop = None
+        self._semaphore = None
+        self._buckets: Dict[int, asyncio.Lock] = {}
+        self._blocked_until: Dict[int, float] = {}
+
+    def _prepare(self) -> None:
+        # asyncio primitives are bound to the loop they are used on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._buckets = {}
+
+    def _bucket(self, channel_id: int) -> asyncio.Lock:
+        bucket = self._buckets.get(channel_id, None)
+        if bucket is None:
+            bucket = asyncio.Lock()
+            self._buckets[channel_id] = bucket
+
+        return bucket
+
+    async def _request(self, channel_id: int, request, started: float):
+        bucket = self._bucket(channel_id)
+        method = getattr(getattr(request, "func", request), "__name__", "unknown")
+        latency = metrics.discord_seconds.labels(method)
+        for attempt in range(self.max_retries + 1):
+            async with bucket:
+                wait = self._blocked_until.get(channel_id, 0) - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                try:
+                    async with self._semaphore:
+                        with latency.time(), tracing.tracer.span(
+                            "discord", method=method, channel=channel_id
+                        ):
+                            result = await request()
+
+                    return result, time.monotonic() - started
+
+                except discord.HTTPException as ex:
+                    if ex.status != 429 or attempt == self.max_retries:
+                        logger.error("Failed to send to channel {}: {}".format(
+                            channel_id, ex))
+                        metrics.discord_failures.labels(method).inc()
+                        return None, None
+
+                    retry_after = _retry_after(ex)
+                    self._blocked_until[channel_id] = time.monotonic() + retry_after
+                    logger.warning("Rate limited on channel {}, retry after {}s.".format(
+                        channel_id, retry_after))
+
+                except Exception as ex:
+                    # connection errors and timeouts fail this channel only
+                    logger.error("Failed to send to channel {}: {!r}".format(
+                        channel_id, ex))
+                    metrics.discord_failures.labels(method).inc()
+                    return None, None
+
+        return None, None
+
+    async def _fanout(self, requests) -> Dict:
+        self._prepare()
+        started = time.monotonic()
+        results = await asyncio.gather(*[
+            self._request(channel_id, request, started)
+            for channel_id, request in requests
+        ])
+        latencies = [latency for _, latency in results if latency is not None]
+        report = {
+            "sent": len(latencies),
+            "failed": len(results) - len(latencies),
+            "first": min(latencies) if latencies else None,
+            "last": max(latencies) if latencies else None,
+            "p95": _percentile(latencies, 95),
+            "results": [
+                result for result, latency in results if latency is not None
+            ],
+        }
+        if latencies:
+            logger.info(
+                "Delivered to {sent} channels ({failed} failed): "
+                "first={first:.3f}s last={last:.3f}s p95={p95:.3f}s".format(**report))
+
+        return report
+
+    async def dispatch(self, channels, content, embed=None) -> Dict:
+        """Send a message to all channels.
+
+        Args:
+            channels (Iterable[discord.abc.Messageable]):
+                Target channels.
+            content (str):
+                Message content.
+            embed (discord.Embed, optional):
+                Message embed.
+        Returns:
+            Dict:
+                Delivery report. Sent/failed counts, first/last/p95
+                delivery latency in seconds and sent messages.
+        """
+        report = await self._fanout([
+            (channel.id, functools.partial(
+                channel.send, content=content, embed=embed))
+            for channel in channels
+        ])
+        report["messages"] = report.pop("results")
+
+        return report
+
+    async def edit(self, messages, content, embed=None) -> Dict:
+        """Edit messages sent by `dispatch`.
+
+        Returns:
+            Dict:
+                Delivery report. Sent/failed counts and first/last/p95
+                delivery latency in seconds.
+        """
+        report = await self._fanout([
+            (message.channel.id, functools.partial(
+                message.edit, content=content, embed=embed))
+            for message in messages
+        ])
+        del report["results"]
+
+        return report
+
+
+_dispatcher: Optional[FanoutDispatcher] = None
+
+def get_dispatcher() -> FanoutDispatcher:
+    global _dispatcher
+    if _dispatcher is None:
+        setting = Setting.get_instance()
+        _dispatcher = FanoutDispatcher(
+            concurrency=int(setting.get(
+                "discord_send_concurrency", DEFAULT_CONCURRENCY)),
+            max_retries=int(setting.get(
+                "discord_send_retries", DEFAULT_MAX_RETRIES)),
+        )
+
+    return _dispatcher
@@ -1,67 +1,92 @@
-import copy
 import asyncio
-import aiohttp
 import logging
 import datetime as dt
+from typing import List
 
 import dateutil.parser
 from discord import Embed
 
-from .setting import Setting
+from .cache import AsyncTTLCache
+from . import twitch
+from . import tracing
 
 
 logger = logging.getLogger(__name__)
 GAME_API = "https://api.twitch.tv/helix/games?id={}"
 USER_API = "https://api.twitch.tv/helix/users?login={}"
 TWTICH_URL_BASE = "https://www.twitch.tv/{}"
-TEMPLATE = {
-    "title": "",
-    "url": "",
-    "timestamp": "",
-    "image": {
-        "url": "",
-    },
-    "thumbnail": {
-        "url": "",
-    },
-    "author": {
-        "name": "",
-        "icon_url": "",
-    },
-    "fields": [
-        {
-            "name": "Game",
-            "value": ""
-        }
-    ]
-}
+GAME_CACHE_SIZE = 512
+GAME_CACHE_TTL = 86400 # seconds
+THUMBNAIL_CACHE_SIZE = 2048
+THUMBNAIL_CACHE_TTL = 3600 # seconds
+# Twitch sends started_at as "YYYY-MM-DDTHH:MM:SSZ".
+RFC3339_LENGTH = 20
+RFC3339_SEPARATORS = "--T::Z" # characters at 4, 7, 10, 13, 16 and 19
+
+game_cache = AsyncTTLCache(maxsize=GAME_CACHE_SIZE, ttl=GAME_CACHE_TTL)
+
+async def _fetch_game_title(game_id: str) -> str:
+    _, json_body = await twitch.request(
+        "GET", GAME_API.format(game_id), priority=twitch.NOTIFY)
+    if len((json_body or {}).get("data", [])) == 0:
+        logger.error("No such game: {}".format(game_id))
+        return None
+
+    return json_body["data"][0]["name"]
 
 async def get_game_title(game_id: str) -> str:
-    setting = Setting.get_instance()
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            GAME_API.format(game_id), headers=setting.get_headers()
-        ) as resp:
-            json_body = await resp.json()
-            if len(json_body["data"]) == 0:
-                logger.error("No such game: {}".format(game_id))
-                return "Unknown"
-
-            return json_body["data"][0]["name"]
+    title = await game_cache.get_or_load(
+        str(game_id), lambda: _fetch_game_title(game_id))
+    if title is None:
+        return "Unknown"
+
+    return title
+
+thumbnail_cache = AsyncTTLCache(
+    maxsize=THUMBNAIL_CACHE_SIZE, ttl=THUMBNAIL_CACHE_TTL)
+
+async def _fetch_user_thumbnail(user_name: str) -> str:
+    _, json_body = await twitch.request(
+        "GET", USER_API.format(user_name), priority=twitch.NOTIFY)
+    json_body = json_body or {}
+    if json_body.get("error", False) or len(json_body.get("data", [])) == 0:
+        logger.error("Unknown user: {}".format(user_name))
+        return None
+
+    return json_body["data"][0]["profile_image_url"]
 
 async def get_user_thumbnail(user_name: str) -> str:
-    setting = Setting.get_instance()
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            USER_API.format(user_name), headers=setting.get_headers()
-        ) as resp:
-            json_body = await resp.json()
-            if json_body.get("error", False):
-                logger.error("Unknown user: {}".format(user_name))
-                return ""
-
-            return json_body["data"][0]["profile_image_url"]
+    thumbnail = await thumbnail_cache.get_or_load(
+        user_name.lower(), lambda: _fetch_user_thumbnail(user_name))
+    if thumbnail is None:
+        return ""
+
+    return thumbnail
+
+async def warm_user_thumbnails(user_names: List[str]) -> int:
+    """Fill the thumbnail cache with batched helix/users lookups.
+
+    Args:
+        user_names (List[str]):
+            Twitch Login Names. Already cached names are skipped.
+    Returns:
+        int:
+            Number of cached thumbnails.
+    """
+    names = [
+        name for name in user_names
+        if name and name.lower() not in thumbnail_cache
+    ]
+    users = await twitch.get_users(names)
+    for login, user in users.items():
+        thumbnail_cache.set(login, user["profile_image_url"])
+    warmed = len(users)
 
+    logger.info("Warmed {} user thumbnails.".format(warmed))
+
+    return warmed
+
+@tracing.traced("embed")
 async def get_message(user_name: str, recieved_data: dict):
     if len(recieved_data["data"]) == 0:
         content = "{}さんの配信が終わったよ.\n{}".format(
@@ -74,10 +99,102 @@ async def get_message(user_name: str, recieved_data: dict):
 
     return content, embed
 
-def parse_iso(iso_str):
-    utc = dateutil.parser.parse(iso_str)
-
-    return utc
+async def update_embed(
+    embed: Embed,
+    title: str,
+    game_id: str,
+    received_data: dict,
+) -> Embed:
+    """Apply title and game changes to an embed made by `get_embed`.
+
+    Unchanged fields are left as they are.
+
+    Args:
+        embed (Embed):
+            Embed to update in place.
+        title (str):
+            Stream title shown in the embed.
+        game_id (str):
+            Twitch GameID shown in the embed.
+        received_data (dict):
+            Webhook payload with the new stream info.
+    Returns:
+        Embed:
+            Updated embed.
+    """
+    stream_info = received_data["data"][0]
+    if stream_info["title"] != title:
+        embed.title = stream_info["title"]
+
+    if stream_info["game_id"] != game_id:
+        embed.set_field_at(
+            0,
+            name="Game",
+            value=await get_game_title(stream_info["game_id"]),
+            inline=False,
+        )
+
+    return embed
+
+def parse_iso(iso_str: str) -> dt.datetime:
+    """Parse a Twitch RFC3339 timestamp.
+
+    The fixed "YYYY-MM-DDTHH:MM:SSZ" format is sliced directly. Anything
+    else falls back to dateutil.
+
+    Args:
+        iso_str (str):
+            Timestamp string such as "2017-08-14T16:08:32Z".
+    Returns:
+        datetime:
+            Parsed timestamp. Aware (UTC) for the fixed format.
+    """
+    if (len(iso_str) == RFC3339_LENGTH
+            and iso_str[4::3] == RFC3339_SEPARATORS):
+        try:
+            return dt.datetime(
+                int(iso_str[0:4]), int(iso_str[5:7]), int(iso_str[8:10]),
+                int(iso_str[11:13]), int(iso_str[14:16]), int(iso_str[17:19]),
+                tzinfo=dt.timezone.utc,
+            )
+
+        except ValueError:
+            pass
+
+    return dateutil.parser.parse(iso_str)
+
+def build_embed(
+    user_name: str,
+    stream_info: dict,
+    user_thumbnail: str,
+    game_title: str,
+) -> Embed:
+    """Build the go-live embed directly, without a template round trip.
+
+    Args:
+        user_name (str):
+            Twitch Login Name.
+        stream_info (dict):
+            One entry of the webhook payload "data".
+        user_thumbnail (str):
+            Profile image URL of the user.
+        game_title (str):
+            Game name shown in the embed.
+    Returns:
+        Embed:
+            Embed for the notification.
+    """
+    embed = Embed(
+        title=stream_info["title"],
+        url=TWTICH_URL_BASE.format(user_name),
+        timestamp=parse_iso(stream_info["started_at"]),
+    )
+    embed.set_image(url=stream_info["thumbnail_url"])
+    embed.set_thumbnail(url=user_thumbnail)
+    embed.set_author(name=user_name, icon_url=user_thumbnail)
+    embed.add_field(name="Game", value=game_title, inline=False)
+
+    return embed
 
 async def get_embed(user_name: str, received_data: dict):
     if len(received_data["data"]) == 0:
@@ -85,17 +202,7 @@ async def get_embed(user_name: str, received_data: dict):
         return None
 
     stream_info = received_data["data"][0]
-    embed_dict = copy.deepcopy(TEMPLATE)
     user_thumbnail = await get_user_thumbnail(user_name)
-    timestamp = parse_iso(stream_info["started_at"])
-
-    embed_dict["title"] = stream_info["title"]
-    embed_dict["url"] = TWTICH_URL_BASE.format(user_name)
-    embed_dict["timestamp"] = dt.datetime.isoformat(timestamp)
-    embed_dict["thumbnail"]["url"] = user_thumbnail
-    embed_dict["image"]["url"] = stream_info["thumbnail_url"]
-    embed_dict["author"]["name"] = user_name
-    embed_dict["author"]["icon_url"] = user_thumbnail
-    embed_dict["fields"][0]["value"] = await get_game_title(stream_info["game_id"])
-
-    return Embed.from_dict(embed_dict)
+    game_title = await get_game_title(stream_info["game_id"])
+
+    return build_embed(user_name, stream_info, user_thumbnail, game_title)
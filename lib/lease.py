@@ -0,0 +1,168 @@
+import heapq
+import random
+import asyncio
+import logging
+import datetime as dt
+from threading import Lock
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MARGIN = 3600 # seconds
+DEFAULT_JITTER = 600 # seconds
+DEFAULT_RETRY = 300 # seconds
+
+
+class LeaseScheduler(object):
+    """Renew subscriptions right before their leases expire.
+
+    Renewal times are kept in a min-heap. The scheduler sleeps until the
+    earliest one, which is `margin` seconds plus a random jitter of up to
+    `jitter` seconds before the lease expires, and then hands every due
+    sub-info id to the renew callback at once. Updates from other threads
+    are accepted and wake the scheduler up.
+
+    Args:
+        margin (float):
+            Seconds before expiry to renew.
+        jitter (float):
+            Max random seconds to renew earlier, to spread renewals.
+        retry (float):
+            Seconds to wait before retrying a failed renewal.
+    """
+
+    def __init__(
+        self,
+        margin: float = DEFAULT_MARGIN,
+        jitter: float = DEFAULT_JITTER,
+        retry: float = DEFAULT_RETRY,
+    ):
+        self.margin = margin
+        self.jitter = jitter
+        self.retry = retry
+        self._lock = Lock()
+        self._heap = list()
+        # sub-info id -> current renewal time, stale heap entries are skipped
+        self._renew_at: Dict[int, dt.datetime] = {}
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def __len__(self):
+        return len(self._renew_at)
+
+    def _push(self, sub_id: int, renew_at: dt.datetime) -> None:
+        self._renew_at[sub_id] = renew_at
+        heapq.heappush(self._heap, (renew_at, sub_id))
+
+    def _notify(self) -> None:
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def schedule(self, sub_id: int, expires_at: dt.datetime) -> None:
+        """Add or update the lease of a subscription."""
+        if not self.running:
+            return
+
+        renew_at = expires_at - dt.timedelta(
+            seconds=self.margin + random.uniform(0, self.jitter))
+        with self._lock:
+            self._push(sub_id, renew_at)
+
+        self._notify()
+
+    def cancel(self, sub_id: int) -> None:
+        """Forget the lease of a removed subscription."""
+        with self._lock:
+            self._renew_at.pop(sub_id, None)
+
+    def load(self, sub_list: Iterable) -> None:
+        """Replace all leases with sub-info rows loaded from DB."""
+        with self._lock:
+            self._heap = list()
+            self._renew_at = dict()
+            for sub in sub_list:
+                # rows stored before the column existed have no expires_at
+                expires_at = sub.expires_at
+                if expires_at is None:
+                    expires_at = sub.get_expired_date()
+                renew_at = expires_at - dt.timedelta(
+                    seconds=self.margin + random.uniform(0, self.jitter))
+                self._push(sub.id, renew_at)
+
+        self._notify()
+        logger.info("Loaded {} leases.".format(len(self._renew_at)))
+
+    def next_renewal(self) -> Optional[dt.datetime]:
+        with self._lock:
+            self._drop_stale()
+            if len(self._heap) == 0:
+                return None
+
+            return self._heap[0][0]
+
+    def _drop_stale(self) -> None:
+        while self._heap and self._renew_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now: dt.datetime) -> List[int]:
+        due = list()
+        with self._lock:
+            self._drop_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _, sub_id = heapq.heappop(self._heap)
+                due.append(sub_id)
+                # retry unless the renewal reschedules it
+                self._push(sub_id, now + dt.timedelta(seconds=self.retry))
+                self._drop_stale()
+
+        return due
+
+    def start(self, renew: Callable[[List[int]], Awaitable]) -> None:
+        """Start renewing on the running loop.
+
+        Args:
+            renew (Callable[[List[int]], Awaitable]):
+                Coroutine function renewing the given sub-info ids.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(renew))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._loop = None
+
+    async def _run(self, renew) -> None:
+        while True:
+            self._wakeup.clear()
+            next_at = self.next_renewal()
+            now = dt.datetime.now()
+            if next_at is None or next_at > now:
+                timeout = None if next_at is None else (next_at - now).total_seconds()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            due = self._pop_due(now)
+            try:
+                await renew(due)
+
+            except Exception as ex:
+                logger.exception(ex)
+
+
+scheduler = LeaseScheduler()
@@ -0,0 +1,275 @@
+import time
+import bisect
+import logging
+from threading import Lock
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+logger = logging.getLogger(__name__)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds, from a cache hit to a slow Helix call
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._children = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        """Get the child of a label combination. Keep the result to skip the lookup."""
+        child = self._children.get(values, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        lines.extend(self._samples())
+
+        return "\n".join(lines)
+
+
+class _CounterChild(object):
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonic counter, optionally labelled."""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, values),
+                _format_value(child.value))
+            for values, child in list(self._children.items())
+        ]
+
+
+class _HistogramChild(object):
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # per bucket counts, the last one is +Inf. cumulated on render
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self) -> "_Timer":
+        return _Timer(self)
+
+
+class _Timer(object):
+    __slots__ = ("child", "start")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(_Metric):
+    """Histogram of durations in seconds, optionally labelled.
+
+    Args:
+        buckets (Sequence[float]):
+            Upper bounds of the buckets, +Inf is added.
+    """
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def _samples(self) -> List[str]:
+        lines = list()
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    _format_labels(self.labelnames, values,
+                                   'le="{}"'.format(_format_value(bound))),
+                    cumulative))
+
+            labels = _format_labels(self.labelnames, values)
+            lines.append("{}_sum{} {}".format(self.name, labels, _format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+
+        return lines
+
+
+class Collector(_Metric):
+    """Values read from their owner at scrape time, free on the hot path.
+
+    Args:
+        kind (str):
+            "counter" or "gauge".
+        collect (Callable[[], Dict[Tuple[str, ...], float]]):
+            Returns values by label values.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        kind: str,
+        collect: Callable[[], Dict[Tuple[str, ...], float]],
+        labelnames: Sequence[str] = (),
+    ):
+        self.kind = kind
+        self.collect = collect
+        super().__init__(name, documentation, labelnames)
+
+    def _samples(self) -> List[str]:
+        try:
+            values = self.collect()
+
+        except Exception as ex:
+            logger.exception(ex)
+            return []
+
+        return [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, labels),
+                _format_value(value))
+            for labels, value in values.items()
+        ]
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text format."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# -- Metrics ------------------------------------------------------------------
+webhook_seconds = Histogram(
+    "webhook_seconds",
+    "Webhook handling from receipt until notifications are sent.",
+    ["path"],
+)
+webhook_events = Counter(
+    "webhook_events_total",
+    "Webhook events by stream state classification.",
+    ["event"],
+)
+webhook_rejected = Counter(
+    "webhook_rejected_total",
+    "Webhooks refused before processing.",
+    ["reason"],
+)
+helix_seconds = Histogram(
+    "helix_request_seconds",
+    "Twitch API calls by endpoint, including rate limit waits.",
+    ["endpoint"],
+)
+helix_failures = Counter(
+    "helix_failures_total",
+    "Twitch API calls that raised or returned an error status.",
+    ["endpoint"],
+)
+db_seconds = Histogram(
+    "db_operation_seconds",
+    "lib.operations calls run in the DB executor.",
+    ["operation"],
+)
+db_failures = Counter(
+    "db_failures_total",
+    "lib.operations calls that raised.",
+    ["operation"],
+)
+discord_seconds = Histogram(
+    "discord_request_seconds",
+    "Discord message requests by method, including rate limit retries.",
+    ["method"],
+)
+discord_failures = Counter(
+    "discord_failures_total",
+    "Discord message requests that failed for good.",
+    ["method"],
+)
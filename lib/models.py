@@ -2,7 +2,8 @@ import os
 import logging
 import datetime as dt
 
-from sqlalchemy import Column, String, DateTime, ForeignKey
+from sqlalchemy import Column, String, DateTime, ForeignKey, Index, text, inspect
+from sqlalchemy.sql import bindparam
 from sqlalchemy.sql.functions import current_timestamp
 from sqlalchemy.dialects.mysql import INTEGER
 
@@ -13,6 +14,12 @@ logger = logging.getLogger(__name__)
 
 class Users(db.Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # webhook routing by user_id and upsert key of add_user
+        Index("uq_users_user_id_guild_id", "user_id", "guild_id", unique=True),
+        # list_users by guild_id
+        Index("ix_users_guild_id", "guild_id"),
+    )
 
     id = Column("id", INTEGER(unsigned=True), primary_key=True, autoincrement=True)
     user_id = Column("user_id", String(256))
@@ -86,8 +93,93 @@ def init_db(force=False):
     else:
         logger.warning("DB file is already exists.")
 
+# (table, unique index, DML) cleaning up rows the unique index would reject.
+# run only while the index is missing, the statements would otherwise delete
+# subscriptions reserved by an in-flight /add
+UNIQUE_CLEANUPS = [
+    # drop duplicated (user_id, guild_id) rows, keeping the newest one
+    ("users", "uq_users_user_id_guild_id", """
+    DELETE FROM users WHERE EXISTS (
+        SELECT 1 FROM users d
+        WHERE d.user_id = users.user_id AND d.guild_id = users.guild_id
+            AND d.id > users.id
+    )
+    """),
+    # collapse per-guild subscriptions into one per Twitch user, keeping the
+    # last renewed one whose secret the hub uses
+    ("sub_info", "uq_sub_info_user_id", """
+    DELETE FROM sub_info WHERE EXISTS (
+        SELECT 1 FROM sub_info d
+        WHERE d.user_id = sub_info.user_id AND (
+            d.date > sub_info.date OR (d.date = sub_info.date AND d.id > sub_info.id))
+    )
+    """),
+    # subscriptions no guild follows anymore are left to expire
+    ("sub_info", "uq_sub_info_user_id", """
+    DELETE FROM sub_info WHERE NOT EXISTS (
+        SELECT 1 FROM users u WHERE u.user_id = sub_info.user_id
+    )
+    """),
+]
+MIGRATIONS = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_users_user_id_guild_id ON users (user_id, guild_id)",
+    "CREATE INDEX IF NOT EXISTS ix_users_guild_id ON users (guild_id)",
+    "DROP INDEX IF EXISTS ix_sub_info_user_id",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_sub_info_user_id ON sub_info (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_sub_info_expires_at ON sub_info (expires_at)",
+]
+# (table, column, DDL) added to tables created by older versions
+NEW_COLUMNS = [
+    ("sub_info", "expires_at", "TIMESTAMP"),
+    ("sub_info", "secret", "VARCHAR(64)"),
+]
+
+def migrate_db(engine=None):
+    """Apply schema changes to tables created by older versions.
+
+    Every statement is idempotent, so this is safe to run on each startup.
+    """
+    engine = engine or db.engine
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table, column, ddl in NEW_COLUMNS:
+            columns = [c["name"] for c in inspector.get_columns(table)]
+            if column not in columns:
+                conn.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table, column, ddl)))
+
+        for table, index, statement in UNIQUE_CLEANUPS:
+            indexes = [i["name"] for i in inspector.get_indexes(table)]
+            if index not in indexes:
+                conn.execute(text(statement))
+
+        for statement in MIGRATIONS:
+            conn.execute(text(statement))
+
+        # fill expires_at of leases stored before the column existed
+        sub_info = SubInfo.__table__
+        rows = conn.execute(sub_info.select().where(
+            sub_info.c.expires_at.is_(None))).fetchall()
+        if len(rows) > 0:
+            conn.execute(
+                sub_info.update().where(sub_info.c.id == bindparam("_id")),
+                [
+                    {
+                        "_id": row.id,
+                        "expires_at": row.date + dt.timedelta(seconds=row.lease_seconds),
+                    }
+                    for row in rows
+                ],
+            )
+
+    logger.info("DB migration finished.")
+
 class SubInfo(db.Base):
     __tablename__ = "sub_info"
+    __table_args__ = (
+        # one subscription per Twitch user, shared by all guilds following it
+        Index("uq_sub_info_user_id", "user_id", unique=True),
+    )
 
     id = Column("id", INTEGER(unsigned=True), primary_key=True, autoincrement=True)
     user_id = Column("user_id", String(256))
@@ -101,6 +193,10 @@ class SubInfo(db.Base):
         nullable=False,
         server_default=current_timestamp()
     )
+    # date + lease_seconds, kept as a column so renewals can filter in SQL
+    expires_at = Column("expires_at", DateTime, index=True)
+    # HMAC key of webhook deliveries, None for subscriptions made without one
+    secret = Column("secret", String(64))
 
     def __init__(
         self,
@@ -108,13 +204,16 @@ class SubInfo(db.Base):
         callback,
         topic,
         lease_seconds,
-        date=dt.datetime.now()
+        date=dt.datetime.now(),
+        secret=None,
     ):
         self.user_id = user_id
         self.callback = callback
         self.topic = topic
         self.lease_seconds = lease_seconds
         self.date = date
+        self.expires_at = self.get_expired_date()
+        self.secret = secret
 
     def __str__(self):
         expired_date = self.get_expired_date()
@@ -139,9 +238,13 @@ class SubInfo(db.Base):
         }
 
     def get_sub_body(self):
-        return {
+        sub_body = {
             "hub.callback": self.callback,
             "hub.mode": "subscribe",
             "hub.topic": self.topic,
             "hub.lease_seconds": self.lease_seconds,
         }
+        if self.secret is not None:
+            sub_body["hub.secret"] = self.secret
+
+        return sub_body
@@ -1,20 +1,115 @@
 import logging
 import datetime as dt
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 
 from . import db
+from . import routing
+from . import lease
 from .models import Users, Channels, SubInfo
 
 
 logger = logging.getLogger(__name__)
 
+def _is_postgresql(session) -> bool:
+    return session.get_bind().dialect.name == "postgresql"
+
+def _upsert_user(
+    session: sqlalchemy.orm.session.Session,
+    user_id: str,
+    user_name: str,
+    guild_id: str,
+    sub_body: Optional[Dict[str, str]],
+    now: dt.datetime,
+) -> Tuple[Optional[int], Optional[Dict[str, object]]]:
+    # returns the sub-info id and values, None when only the guild row was
+    # written. the caller commits
+    if _is_postgresql(session):
+        # INSERT ... ON CONFLICT DO UPDATE
+        statement = postgresql.insert(Users.__table__).values(
+            user_id=str(user_id),
+            user_name=user_name,
+            guild_id=str(guild_id),
+            update_date=now,
+        )
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[Users.user_id, Users.guild_id],
+            set_={"user_name": statement.excluded.user_name},
+        ))
+
+    else:
+        user = session.query(Users).filter(
+            Users.user_id == str(user_id), Users.guild_id == str(guild_id)
+        ).first()
+        if user is None:
+            session.add(Users(
+                user_id=user_id,
+                user_name=user_name,
+                guild_id=guild_id,
+                update_date=now
+            ))
+
+        else:
+            user.user_name = user_name
+
+    if sub_body is None:
+        return None, None
+
+    sub_values = {
+        "user_id": str(user_id),
+        "callback": sub_body["hub.callback"],
+        "topic": sub_body["hub.topic"],
+        "lease_seconds": sub_body["hub.lease_seconds"],
+        "date": now,
+        "expires_at": now + dt.timedelta(
+            seconds=int(sub_body["hub.lease_seconds"])),
+        "secret": sub_body.get("hub.secret", None),
+    }
+    if _is_postgresql(session):
+        # one subscription per Twitch user, shared by all guilds
+        statement = postgresql.insert(SubInfo.__table__).values(**sub_values)
+        row = session.execute(statement.on_conflict_do_update(
+            index_elements=[SubInfo.user_id],
+            set_={
+                key: getattr(statement.excluded, key)
+                for key in (
+                    "callback", "topic", "lease_seconds", "date",
+                    "expires_at", "secret",
+                )
+            },
+        ).returning(SubInfo.id)).first()
+        sub_id = row.id
+
+    else:
+        sub_info = session.query(SubInfo).filter(
+            SubInfo.user_id == str(user_id)).first()
+        if sub_info is None:
+            sub_info = SubInfo(
+                user_id=str(user_id),
+                callback=sub_body["hub.callback"],
+                topic=sub_body["hub.topic"],
+                lease_seconds=sub_body["hub.lease_seconds"],
+                date=now,
+                secret=sub_values["secret"],
+            )
+            session.add(sub_info)
+            session.flush()
+
+        else:
+            for key, value in sub_values.items():
+                setattr(sub_info, key, value)
+
+        sub_id = sub_info.id
+
+    return sub_id, sub_values
+
 def add_user(
     user_id: str,
     user_name: str,
     guild_id: str,
-    sub_body: Dict[str, str],
+    sub_body: Optional[Dict[str, str]],
     session:sqlalchemy.orm.session.Session = db.session,
 ) -> bool:
     """Add a user to DB
@@ -26,8 +121,10 @@ def add_user(
             Twitch Login Name.
         guild_id (str):
             Discord Guild ID.
-        sub_body (Dict[str, str]):
-            Twitch Webhook Subscription Parameters.
+        sub_body (Optional[Dict[str, str]]):
+            Twitch Webhook Subscription Parameters. The subscription is
+            shared by all guilds of the user. None to only attach the
+            guild to the existing subscription.
         session (sqlalchemy.orm.session.Session, optional):
             DB Session to operate.
             Default: db.session.
@@ -35,38 +132,44 @@ def add_user(
         bool:
             Success or faild.
     """
-    try:
-        query = session.query(Users).filter(
-            Users.user_id == str(user_id), Users.guild_id == str(guild_id))
-        if query.count() == 0:
-            user = Users(
-                user_id=user_id,
-                user_name=user_name,
-                guild_id=guild_id,
-                update_date=dt.datetime.now()
-            )
-            sub_info = SubInfo(
-                user_id=user_id,
-                callback=sub_body["hub.callback"],
-                topic=sub_body["hub.topic"],
-                lease_seconds=sub_body["hub.lease_seconds"],
-                date=dt.datetime.now()
-            )
-            session.add(user)
-            session.add(sub_info)
-            session.commit()
-
-        else:
-            user = query.first()
-            user.user_name = user_name
+    return add_users([{
+        "user_id": user_id,
+        "user_name": user_name,
+        "guild_id": guild_id,
+        "sub_body": sub_body,
+    }], session=session)
+
+def add_users(
+    users: List[Dict[str, object]],
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> bool:
+    """Add users to DB in one transaction.
 
-            sub_info = session.query(SubInfo).filter(SubInfo.id == user.id).first()
-            sub_info.callback = sub_body["hub.callback"]
-            sub_info.topic = sub_body["hub.topic"]
-            sub_info.lease_seconds = sub_body["hub.lease_seconds"]
-            sub_info.date = dt.datetime.now()
+    Args:
+        users (List[Dict[str, object]]):
+            Keyword arguments of `add_user` without session.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB Session to operate.
+            Default: db.session.
+    Returns:
+        bool:
+            Success or faild. Nothing is added on failure.
+    """
+    try:
+        now = dt.datetime.now()
+        added = [
+            (user, _upsert_user(session, now=now, **user))
+            for user in users
+        ]
+        session.commit()
 
-            session.commit()
+        for user, (sub_id, sub_values) in added:
+            routing.table.add_user(
+                user["user_id"], user["user_name"], user["guild_id"])
+            if sub_id is not None:
+                routing.table.set_secret(
+                    user["user_id"], sub_id, sub_values["secret"])
+                lease.scheduler.schedule(sub_id, sub_values["expires_at"])
 
     except Exception as ex:
         logger.exception(ex)
@@ -79,6 +182,60 @@ def add_user(
 
     return True
 
+def _delete_user(
+    session: sqlalchemy.orm.session.Session,
+    user_id: str,
+    guild_id: str,
+) -> Tuple[bool, Optional[SubInfo]]:
+    # returns whether the user was registered and the sub-info deleted with
+    # the last guild. the caller commits
+    condition = sqlalchemy.and_(
+        Users.user_id == str(user_id), Users.guild_id == str(guild_id))
+    if _is_postgresql(session):
+        # DELETE ... RETURNING
+        row = session.execute(
+            Users.__table__.delete().where(condition).returning(Users.id)
+        ).first()
+        if row is None:
+            logger.error("No such user registered: {}".format(user_id))
+            return False, None
+
+        # drop the subscription only when no guild follows the user anymore
+        row = session.execute(
+            SubInfo.__table__.delete().where(sqlalchemy.and_(
+                SubInfo.user_id == str(user_id),
+                ~sqlalchemy.exists().where(Users.user_id == str(user_id)),
+            )).returning(*SubInfo.__table__.c)
+        ).first()
+        sub_info = None if row is None else SubInfo(
+            user_id=row.user_id,
+            callback=row.callback,
+            topic=row.topic,
+            lease_seconds=row.lease_seconds,
+            date=row.date,
+            secret=row.secret,
+        )
+        if sub_info is not None:
+            sub_info.id = row.id
+
+    else:
+        user = session.query(Users).filter(condition).first()
+        if user is None:
+            logger.error("No such user registered: {}".format(user_id))
+            return False, None
+
+        session.delete(user)
+        followed = session.query(Users.id).filter(
+            Users.user_id == str(user_id)).first()
+        sub_info = None
+        if followed is None:
+            sub_info = session.query(SubInfo).filter(
+                SubInfo.user_id == str(user_id)).first()
+            if sub_info is not None:
+                session.delete(sub_info)
+
+    return True, sub_info
+
 def remove_user(
     user_id: str,
     guild_id: str,
@@ -96,31 +253,65 @@ def remove_user(
             Default: db.session.
     Returns:
         SubInfo:
-            Twitch Webhooks SubscriptinInfo.
+            Twitch Webhooks SubscriptinInfo to unsubscribe. None if other
+            guilds still follow the user.
+    """
+    removed = remove_users([user_id], guild_id, session=session)
+    if removed is None:
+        return None
+
+    return removed.get(str(user_id), None)
+
+def remove_users(
+    user_ids: List[str],
+    guild_id: str,
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> Dict[str, Optional[SubInfo]]:
+    """Remove users of a guild from DB in one transaction.
+
+    Args:
+        user_ids (List[str]):
+            Twitch UserIDs.
+        guild_id (str):
+            Discord GuildID.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        Dict[str, Optional[SubInfo]]:
+            Removed users by Twitch UserID, with the subscription to
+            unsubscribe when the guild was the last one following the user.
+            Users that were not registered are missing. None on failure.
     """
+    removed = None
     try:
-        query = session.query(Users).filter(
-            Users.user_id == str(user_id), Users.guild_id == str(guild_id))
-        if query.count() == 0:
-            logger.error("No such user registered.")
-            return None
+        deleted = {
+            str(user_id): _delete_user(session, user_id, guild_id)
+            for user_id in user_ids
+        }
+        session.commit()
 
-        else:
-            user = query.first()
-            sub_info = session.query(SubInfo).filter(SubInfo.id == user.id).first()
-            session.delete(user)
-            session.delete(sub_info)
+        removed = dict()
+        for user_id, (registered, sub_info) in deleted.items():
+            if not registered:
+                continue
 
-            session.commit()
+            removed[user_id] = sub_info
+            routing.table.remove_user(user_id, guild_id)
+            if sub_info is not None:
+                routing.table.remove_secret(sub_info.user_id, sub_info.id)
+                lease.scheduler.cancel(sub_info.id)
 
     except Exception as ex:
         logger.exception(ex)
+        session.rollback()
+
         return None
 
     finally:
         session.close()
 
-    return sub_info
+    return removed
 
 def list_users(
     guild_id: str,
@@ -153,12 +344,10 @@ def list_users(
 def get_users(user_id, session=db.session) -> List[Users]:
     users = None
     try:
-        query = session.query(Users).filter(Users.user_id == str(user_id))
-        if query.count() == 0:
+        users = session.query(Users).filter(Users.user_id == str(user_id)).all()
+        if len(users) == 0:
             logger.error("No such user: {}".format(user_id))
-
-        else:
-            users = query.all()
+            users = None
 
     except Exception as ex:
         logger.exception(ex)
@@ -168,6 +357,66 @@ def get_users(user_id, session=db.session) -> List[Users]:
 
     return users
 
+def get_delivery_targets(
+    user_id: str,
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> List[Tuple[Users, str]]:
+    """List delivery targets of a Twitch user in a single query.
+
+    Args:
+        user_id (str):
+            Twitch UserID.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        List[Tuple[Users, str]]:
+            Registered users and Discord ChannelIDs of their guilds.
+            Guilds without a registered channel are not included.
+    """
+    targets = None
+    try:
+        targets = session.query(Users, Channels.channel_id).join(
+            Channels, Channels.guild_id == Users.guild_id
+        ).filter(Users.user_id == str(user_id)).all()
+
+    except Exception as ex:
+        logger.exception(ex)
+
+    finally:
+        session.close()
+
+    return targets
+
+def list_all_users(session=db.session) -> List[Users]:
+    all_users = None
+    try:
+        all_users = session.query(Users).all()
+
+    except Exception as ex:
+        logger.exception(ex)
+
+    finally:
+        session.close()
+
+    return all_users
+
+def list_user_names(session=db.session) -> List[str]:
+    user_names = None
+    try:
+        user_names = [
+            row.user_name
+            for row in session.query(Users.user_name).distinct()
+        ]
+
+    except Exception as ex:
+        logger.exception(ex)
+
+    finally:
+        session.close()
+
+    return user_names
+
 def list_subinfo(session=db.session) -> List[SubInfo]:
     sub_info_list = None
     try:
@@ -181,20 +430,288 @@ def list_subinfo(session=db.session) -> List[SubInfo]:
 
     return sub_info_list
 
-def update_subinfo(sub_info_id: int, session=db.session) -> bool:
+def list_secrets(
+    user_id: str,
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> Dict[int, str]:
+    """Get webhook secrets of a Twitch user's subscriptions.
+
+    Args:
+        user_id (str):
+            Twitch UserID.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        Dict[int, str]:
+            Secrets by sub-info id. None for subscriptions without one.
+    """
+    secrets = None
     try:
-        query = session.query(SubInfo).filter(SubInfo.id == sub_info_id)
-        if query.count() == 0:
-            logger.error("No such sub-info: {}".format(sub_info_id))
-            return False
+        secrets = {
+            row.id: row.secret for row in session.query(
+                SubInfo.id, SubInfo.secret
+            ).filter(SubInfo.user_id == str(user_id))
+        }
 
-        else:
-            sub_info = query.first()
-            sub_info.date = dt.datetime.now()
-            session.commit()
+    except Exception as ex:
+        logger.exception(ex)
+
+    finally:
+        session.close()
+
+    return secrets
+
+def list_expiring_subinfo(
+    before: dt.datetime,
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> List[SubInfo]:
+    """List subscriptions expiring until the given time.
+
+    Args:
+        before (dt.datetime):
+            Subscriptions expiring at or before this time are listed.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        List[SubInfo]:
+            Expiring subscriptions, earliest first.
+    """
+    sub_info_list = None
+    try:
+        sub_info_list = session.query(SubInfo).filter(
+            SubInfo.expires_at <= before
+        ).order_by(SubInfo.expires_at).all()
+
+    except Exception as ex:
+        logger.exception(ex)
+
+    finally:
+        session.close()
+
+    return sub_info_list
+
+def list_subinfo_by_ids(
+    sub_info_ids: List[int],
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> List[SubInfo]:
+    sub_info_list = None
+    try:
+        sub_info_list = session.query(SubInfo).filter(
+            SubInfo.id.in_(list(sub_info_ids))).all()
+
+    except Exception as ex:
+        logger.exception(ex)
+
+    finally:
+        session.close()
+
+    return sub_info_list
+
+def list_subinfo_by_user_ids(
+    user_ids: List[str],
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> List[SubInfo]:
+    """List subscriptions of Twitch users.
+
+    Args:
+        user_ids (List[str]):
+            Twitch UserIDs.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        List[SubInfo]:
+            Subscriptions, at most one per user.
+    """
+    sub_info_list = None
+    try:
+        sub_info_list = session.query(SubInfo).filter(
+            SubInfo.user_id.in_([str(user_id) for user_id in user_ids])).all()
+
+    except Exception as ex:
+        logger.exception(ex)
+
+    finally:
+        session.close()
+
+    return sub_info_list
+
+def reserve_subinfo(
+    sub_bodies: Dict[str, Dict[str, str]],
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> Optional[Dict[str, str]]:
+    """Store sub-infos before their hub requests, keeping existing ones.
+
+    Concurrent subscriptions of a user then post the secret stored first,
+    so the hub and DB agree on it whichever request is processed last.
+    A reserved lease is expired until `add_users` records the accepted one.
+
+    Args:
+        sub_bodies (Dict[str, Dict[str, str]]):
+            Twitch Webhook Subscription Parameters with "hub.secret", by
+            Twitch UserID.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        Optional[Dict[str, str]]:
+            Secret to post by Twitch UserID. None on failure.
+    """
+    secrets = None
+    try:
+        now = dt.datetime.now()
+        rows = [
+            {
+                "user_id": str(user_id),
+                "callback": sub_body["hub.callback"],
+                "topic": sub_body["hub.topic"],
+                "lease_seconds": sub_body["hub.lease_seconds"],
+                "date": now,
+                "expires_at": now,
+                "secret": sub_body["hub.secret"],
+            }
+            for user_id, sub_body in sub_bodies.items()
+        ]
+        user_ids = [row["user_id"] for row in rows]
+        if len(rows) > 0:
+            if _is_postgresql(session):
+                # INSERT ... ON CONFLICT DO NOTHING
+                session.execute(postgresql.insert(SubInfo.__table__).values(
+                    rows).on_conflict_do_nothing(index_elements=[SubInfo.user_id]))
+
+            else:
+                existing = {
+                    user_id for user_id, in session.query(SubInfo.user_id).filter(
+                        SubInfo.user_id.in_(user_ids))
+                }
+                session.bulk_insert_mappings(
+                    SubInfo, [row for row in rows if row["user_id"] not in existing])
+
+        secrets = dict(session.query(SubInfo.user_id, SubInfo.secret).filter(
+            SubInfo.user_id.in_(user_ids)).all()) if len(rows) > 0 else {}
+        session.commit()
+
+    except Exception as ex:
+        logger.exception(ex)
+        session.rollback()
+        secrets = None
+
+    finally:
+        session.close()
+
+    return secrets
+
+def release_subinfo(
+    user_ids: List[str],
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> bool:
+    """Delete sub-infos reserved for subscriptions that were not made.
+
+    Sub-infos followed by a guild meanwhile are kept.
+
+    Args:
+        user_ids (List[str]):
+            Twitch UserIDs.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        bool:
+            Success or faild.
+    """
+    try:
+        followed = session.query(Users.user_id).filter(
+            Users.user_id == SubInfo.user_id).exists()
+        session.query(SubInfo).filter(
+            SubInfo.user_id.in_([str(user_id) for user_id in user_ids]),
+            ~followed,
+        ).delete(synchronize_session=False)
+        session.commit()
+
+    except Exception as ex:
+        logger.exception(ex)
+        session.rollback()
+
+        return False
+
+    finally:
+        session.close()
+
+    return True
+
+def save_subinfo_secrets(
+    sub_info_list: List[SubInfo],
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> bool:
+    """Store webhook secrets of subscriptions in one bulk UPDATE.
+
+    Args:
+        sub_info_list (List[SubInfo]):
+            Subscriptions with their secret set.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        bool:
+            Success or faild.
+    """
+    try:
+        session.bulk_update_mappings(SubInfo, [
+            {"id": sub_info.id, "secret": sub_info.secret}
+            for sub_info in sub_info_list
+        ])
+        session.commit()
+
+    except Exception as ex:
+        logger.exception(ex)
+        session.rollback()
+
+        return False
+
+    finally:
+        session.close()
+
+    return True
+
+def renew_subinfo(
+    sub_info_list: List[SubInfo],
+    session: sqlalchemy.orm.session.Session = db.session,
+) -> bool:
+    """Mark subscriptions as renewed now in one bulk UPDATE.
+
+    Args:
+        sub_info_list (List[SubInfo]):
+            Renewed subscriptions.
+        session (sqlalchemy.orm.session.Session, optional):
+            DB session to operate.
+            Default: db.session.
+    Returns:
+        bool:
+            Success or faild.
+    """
+    try:
+        now = dt.datetime.now()
+        mappings = [
+            {
+                "id": sub_info.id,
+                "date": now,
+                "expires_at": now + dt.timedelta(seconds=sub_info.lease_seconds),
+                "secret": sub_info.secret,
+            }
+            for sub_info in sub_info_list
+        ]
+        session.bulk_update_mappings(SubInfo, mappings)
+        session.commit()
+
+        for sub_info, mapping in zip(sub_info_list, mappings):
+            routing.table.set_secret(sub_info.user_id, sub_info.id, sub_info.secret)
+            lease.scheduler.schedule(mapping["id"], mapping["expires_at"])
 
     except Exception as ex:
         logger.exception(ex)
+        session.rollback()
 
         return False
 
@@ -209,20 +726,32 @@ def register_channel(
     session=db.session,
 ):
     try:
-        query = session.query(Channels).filter(Channels.guild_id == str(guild_id))
-        if query.count() == 0:
-            channel = Channels(
-                guild_id=guild_id,
-                channel_id=channel_id,
+        if _is_postgresql(session):
+            # INSERT ... ON CONFLICT DO UPDATE
+            statement = postgresql.insert(Channels.__table__).values(
+                guild_id=str(guild_id),
+                channel_id=str(channel_id),
+                date=dt.datetime.now(),
             )
-            session.add(channel)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[Channels.guild_id],
+                set_={"channel_id": statement.excluded.channel_id},
+            ))
 
         else:
-            channel = query.first()
-            channel.guild_id = guild_id
-            channel.channel_id = channel_id
+            channel = session.query(Channels).get(str(guild_id))
+            if channel is None:
+                session.add(Channels(
+                    guild_id=str(guild_id),
+                    channel_id=str(channel_id),
+                    date=dt.datetime.now(),
+                ))
+
+            else:
+                channel.channel_id = str(channel_id)
 
         session.commit()
+        routing.table.set_channel(guild_id, channel_id)
 
     except Exception as ex:
         logger.exception(ex)
@@ -251,15 +780,10 @@ def list_channels(session=db.session):
 def get_channel(guild_id, session=db.session) -> Channels:
     channel = None
     try:
-        query = session.query(Channels).filter(
-            Channels.guild_id == str(guild_id))
-        if query.count() == 0:
+        channel = session.query(Channels).get(str(guild_id))
+        if channel is None:
             logger.error("No such channel: {}".format(guild_id))
 
-            return channel
-
-        channel = query.first()
-
     except Exception as ex:
         logger.exception(ex)
 
@@ -271,22 +795,18 @@ def get_channel(guild_id, session=db.session) -> Channels:
 def get_channel_by_user(user_id, guild_id, session=db.session) -> str:
     channel_id = None
     try:
-        query = session.query(Users).filter(
-            Users.user_id == str(user_id), Users.guild_id == str(guild_id))
-        if query.count() == 0:
-            logger.error("No such user: {}".format(user_id))
-
-            return channel_id
-
-        user = query.first()
-        query = session.query(Channels).filter(Channels.guild_id == user.guild_id)
-        if query.count() == 0:
-            logger.error("No valid channel: GuildID={}".format(user.guild_id))
+        row = session.query(Channels.channel_id).join(
+            Users, Users.guild_id == Channels.guild_id
+        ).filter(
+            Users.user_id == str(user_id), Users.guild_id == str(guild_id)
+        ).first()
+        if row is None:
+            logger.error("No valid channel: UserID={}, GuildID={}".format(
+                user_id, guild_id))
 
             return channel_id
 
-        channel = query.first()
-        channel_id = channel.channel_id
+        channel_id = row.channel_id
 
     except Exception as ex:
         logger.exception(ex)
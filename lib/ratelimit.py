@@ -0,0 +1,182 @@
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from typing import Dict, List, Mapping, Tuple
+
+
+logger = logging.getLogger(__name__)
+# priority classes, lower is served first
+NOTIFY = 0
+INTERACTIVE = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {
+    NOTIFY: "notify",
+    INTERACTIVE: "interactive",
+    BACKGROUND: "background",
+}
+DEFAULT_CAPACITY = 30 # points per minute of Helix without a token
+DEFAULT_WINDOW = 60.0 # seconds to refill the bucket
+DEFAULT_RESERVE = 0.1 # share of the bucket background requests leave over
+
+
+class TokenBucket(object):
+    """Token bucket in front of the Helix rate limit.
+
+    Requests wait for a token in priority order. After every response the
+    bucket is synced to the Ratelimit-Limit, Ratelimit-Remaining and
+    Ratelimit-Reset headers, so it follows what Twitch actually counts.
+    Background requests leave a reserve of tokens for the other classes.
+
+    Args:
+        capacity (int):
+            Bucket size until the first response tells the real one.
+        window (float):
+            Seconds to refill an empty bucket.
+        reserve (float):
+            Share of the bucket background requests may not use.
+    """
+
+    def __init__(
+        self,
+        capacity: int = DEFAULT_CAPACITY,
+        window: float = DEFAULT_WINDOW,
+        reserve: float = DEFAULT_RESERVE,
+    ):
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.rate = self.capacity / window
+        self.window = window
+        self.reserve = reserve
+        self._updated = time.monotonic()
+        self._seq = itertools.count()
+        self._waiters: List[Tuple[int, int, asyncio.Future, float]] = []
+        self._loop = None
+        self._wakeup = None
+        self._pump_task = None
+        self._waits = {
+            priority: {"count": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    def _prepare(self) -> None:
+        # waiters of another loop can never be woken up, start over
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._waiters = []
+            self._pump_task = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _needed(self, priority: int) -> float:
+        if priority == BACKGROUND:
+            return 1.0 + self.capacity * self.reserve
+
+        return 1.0
+
+    async def acquire(self, priority: int = BACKGROUND) -> float:
+        """Wait for a token.
+
+        Args:
+            priority (int):
+                NOTIFY, INTERACTIVE or BACKGROUND.
+        Returns:
+            float:
+                Seconds waited.
+        """
+        self._prepare()
+        future = self._loop.create_future()
+        start = time.monotonic()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future, start))
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+        await future
+        wait = time.monotonic() - start
+        waits = self._waits[priority]
+        waits["count"] += 1
+        waits["total_wait"] += wait
+        waits["max_wait"] = max(waits["max_wait"], wait)
+
+        return wait
+
+    async def _pump(self) -> None:
+        while len(self._waiters) > 0:
+            priority, _, future, _ = self._waiters[0]
+            if future.done():
+                # cancelled waiter
+                heapq.heappop(self._waiters)
+                continue
+
+            self._refill()
+            needed = self._needed(priority)
+            if self.tokens >= needed:
+                heapq.heappop(self._waiters)
+                self.tokens -= 1.0
+                future.set_result(None)
+                continue
+
+            # wake up for the next token, or earlier for a new waiter or sync
+            self._wakeup.clear()
+            delay = (needed - self.tokens) / self.rate
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+
+            except asyncio.TimeoutError:
+                pass
+
+    def sync(self, headers: Mapping[str, str]) -> None:
+        """Adopt the rate limit state reported by a Helix response."""
+        try:
+            limit = float(headers["Ratelimit-Limit"])
+            remaining = float(headers["Ratelimit-Remaining"])
+            reset = float(headers["Ratelimit-Reset"])
+
+        except (KeyError, TypeError, ValueError):
+            return
+
+        self._refill()
+        self.capacity = max(limit, 1.0)
+        # requests in flight have taken tokens the response did not count yet
+        self.tokens = min(self.tokens, remaining)
+        until_reset = reset - time.time()
+        if remaining < limit and until_reset > 0:
+            # the bucket is full again at reset
+            self.rate = max((limit - remaining) / until_reset, 1.0 / self.window)
+
+        else:
+            self.rate = self.capacity / self.window
+
+        if remaining <= 0:
+            logger.warning("Helix rate limit exhausted, {:.1f}s until reset.".format(
+                max(until_reset, 0.0)))
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self) -> Dict[str, object]:
+        """Bucket state and queue wait times by priority class."""
+        self._refill()
+        stats = {
+            "tokens": self.tokens,
+            "capacity": self.capacity,
+            "rate": self.rate,
+            "queued": sum(1 for waiter in self._waiters if not waiter[2].done()),
+        }
+        for priority, name in PRIORITY_NAMES.items():
+            waits = self._waits[priority]
+            stats[name] = {
+                "count": waits["count"],
+                "avg_wait": waits["total_wait"] / waits["count"] if waits["count"] else 0.0,
+                "max_wait": waits["max_wait"],
+            }
+
+        return stats
@@ -0,0 +1,110 @@
+import logging
+from typing import Dict, Iterable
+
+from .cache import AsyncTTLCache
+from . import routing
+from . import twitch
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_TTL = 86400 # seconds
+DEFAULT_NEGATIVE_TTL = 600 # seconds
+
+
+class LoginResolver(object):
+    """Resolve Twitch logins to users with as few Helix calls as possible.
+
+    Logins are looked up in the routing table index of registered users
+    first, then in a TTL cache of earlier Helix results, and only the rest
+    is sent to helix/users in batches. Logins Helix does not know are
+    remembered for a shorter TTL, logins of failed requests are not.
+
+    Args:
+        maxsize (int):
+            Max number of cached logins, for each cache.
+        ttl (float):
+            Seconds to remember a resolved login.
+        negative_ttl (float):
+            Seconds to remember an unknown login.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = DEFAULT_CACHE_SIZE,
+        ttl: float = DEFAULT_TTL,
+        negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+    ):
+        self.cache = AsyncTTLCache(maxsize=maxsize, ttl=ttl)
+        self.negative_cache = AsyncTTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self.local = 0
+        self.cached = 0
+        self.negative = 0
+        self.remote = 0
+        self.not_found = 0
+
+    async def resolve(
+        self,
+        logins: Iterable[str],
+        priority: int = twitch.BACKGROUND,
+    ) -> Dict[str, dict]:
+        """Resolve logins to users.
+
+        Args:
+            logins (Iterable[str]):
+                Twitch Login Names.
+            priority (int, optional):
+                Priority class of Helix requests.
+                Default: BACKGROUND.
+        Returns:
+            Dict[str, dict]:
+                Users by lowercase login, with at least "id" and "login".
+                Entries from Helix are complete helix/users entries.
+                Unknown logins are missing.
+        """
+        users = dict()
+        missing = list()
+        for login in {login.lower() for login in logins if login}:
+            user_id = routing.table.get_user_id(login)
+            if user_id is not None:
+                self.local += 1
+                users[login] = {"id": user_id, "login": login}
+                continue
+
+            user = self.cache.get(login)
+            if user is not None:
+                self.cached += 1
+                users[login] = user
+                continue
+
+            if login in self.negative_cache:
+                self.negative += 1
+                continue
+
+            missing.append(login)
+
+        if len(missing) > 0:
+            self.remote += len(missing)
+            found, unknown = await twitch.lookup_users(missing, priority=priority)
+            for login, user in found.items():
+                self.cache.set(login, user)
+                users[login] = user
+
+            for login in unknown:
+                self.not_found += 1
+                self.negative_cache.set(login, True)
+
+        return users
+
+    def stats(self) -> Dict[str, int]:
+        """Lookup counters. local, cached and negative were served locally."""
+        return {
+            "local": self.local,
+            "cached": self.cached,
+            "negative": self.negative,
+            "remote": self.remote,
+            "not_found": self.not_found,
+        }
+
+
+resolver = LoginResolver()
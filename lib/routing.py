@@ -0,0 +1,191 @@
+import logging
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class RoutingTable(object):
+    """In-memory index of webhook delivery targets by Twitch UserID.
+
+    The table stays empty until `load` is called. Until then `get_targets`
+    returns None and write-through updates are ignored, so callers fall
+    back to the DB.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._lock = Lock()
+        # user_id -> {guild_id: user_name}
+        self._users: Dict[str, Dict[str, str]] = {}
+        # guild_id -> channel_id
+        self._channels: Dict[str, str] = {}
+        # user_id -> {sub-info id: webhook secret}
+        self._secrets: Dict[str, Dict[int, Optional[str]]] = {}
+        # user_id -> {sub-info id: secret replaced by a pending rotation}
+        self._previous: Dict[str, Dict[int, Optional[str]]] = {}
+        # lowercase login -> user_id
+        self._logins: Dict[str, str] = {}
+
+    def load(
+        self,
+        users: Iterable,
+        channels: Iterable,
+        sub_list: Iterable = (),
+    ) -> None:
+        """Replace the table with rows loaded from DB.
+
+        Args:
+            users (Iterable[Users]):
+                All registered users.
+            channels (Iterable[Channels]):
+                All registered channels.
+            sub_list (Iterable[SubInfo], optional):
+                All subscriptions, for their webhook secrets.
+        """
+        user_map = dict()
+        login_map = dict()
+        for user in users:
+            user_map.setdefault(str(user.user_id), {})[str(user.guild_id)] = user.user_name
+            login_map[user.user_name.lower()] = str(user.user_id)
+
+        channel_map = {
+            str(channel.guild_id): str(channel.channel_id) for channel in channels
+        }
+        secret_map = dict()
+        for sub in sub_list:
+            secret_map.setdefault(str(sub.user_id), {})[sub.id] = sub.secret
+
+        with self._lock:
+            self._users = user_map
+            self._channels = channel_map
+            self._secrets = secret_map
+            self._previous = {}
+            self._logins = login_map
+            self.loaded = True
+
+        logger.info("Loaded routing table: {} users, {} channels.".format(
+            len(user_map), len(channel_map)))
+
+    def add_user(self, user_id, user_name, guild_id) -> None:
+        if not self.loaded:
+            return
+
+        with self._lock:
+            self._users.setdefault(str(user_id), {})[str(guild_id)] = user_name
+            self._logins[user_name.lower()] = str(user_id)
+
+    def remove_user(self, user_id, guild_id) -> None:
+        if not self.loaded:
+            return
+
+        with self._lock:
+            guilds = self._users.get(str(user_id), {})
+            user_name = guilds.pop(str(guild_id), None)
+            if len(guilds) == 0:
+                self._users.pop(str(user_id), None)
+                if user_name is not None and self._logins.get(
+                        user_name.lower()) == str(user_id):
+                    del self._logins[user_name.lower()]
+
+    def set_channel(self, guild_id, channel_id) -> None:
+        if not self.loaded:
+            return
+
+        with self._lock:
+            self._channels[str(guild_id)] = str(channel_id)
+
+    def set_secret(self, user_id, sub_id, secret) -> None:
+        if not self.loaded:
+            return
+
+        with self._lock:
+            self._secrets.setdefault(str(user_id), {})[sub_id] = secret
+            self._drop_previous(user_id, sub_id)
+
+    def rotate_secret(self, user_id, sub_id, secret) -> None:
+        """Accept a new secret of a subscription next to its current one.
+
+        The current secret stays accepted until the next `set_secret` or
+        `remove_secret` of the subscription.
+        """
+        if not self.loaded:
+            return
+
+        with self._lock:
+            secrets = self._secrets.setdefault(str(user_id), {})
+            if sub_id in secrets:
+                self._previous.setdefault(str(user_id), {})[sub_id] = secrets[sub_id]
+            secrets[sub_id] = secret
+
+    def remove_secret(self, user_id, sub_id) -> None:
+        if not self.loaded:
+            return
+
+        with self._lock:
+            secrets = self._secrets.get(str(user_id), {})
+            secrets.pop(sub_id, None)
+            if len(secrets) == 0:
+                self._secrets.pop(str(user_id), None)
+            self._drop_previous(user_id, sub_id)
+
+    def _drop_previous(self, user_id, sub_id) -> None:
+        previous = self._previous.get(str(user_id), {})
+        previous.pop(sub_id, None)
+        if len(previous) == 0:
+            self._previous.pop(str(user_id), None)
+
+    def get_secrets(self, user_id) -> Optional[List[Optional[str]]]:
+        """Get webhook secrets of a Twitch user's subscriptions.
+
+        Returns:
+            Optional[List[Optional[str]]]:
+                Secrets, None for subscriptions without one.
+                None if the table is not loaded.
+        """
+        if not self.loaded:
+            return None
+
+        with self._lock:
+            return (
+                list(self._secrets.get(str(user_id), {}).values())
+                + list(self._previous.get(str(user_id), {}).values())
+            )
+
+    def get_user_id(self, login) -> Optional[str]:
+        """Get the Twitch UserID of a registered login.
+
+        Returns:
+            Optional[str]:
+                None if the login is not registered or the table is not
+                loaded.
+        """
+        if not self.loaded:
+            return None
+
+        with self._lock:
+            return self._logins.get(login.lower(), None)
+
+    def get_targets(self, user_id) -> Optional[List[Tuple[str, str]]]:
+        """Get delivery targets of a Twitch user.
+
+        Returns:
+            Optional[List[Tuple[str, str]]]:
+                Twitch Login Names and Discord ChannelIDs.
+                None if the table is not loaded.
+        """
+        if not self.loaded:
+            return None
+
+        with self._lock:
+            guilds = self._users.get(str(user_id), {})
+
+            return [
+                (user_name, self._channels[guild_id])
+                for guild_id, user_name in guilds.items()
+                if guild_id in self._channels
+            ]
+
+
+table = RoutingTable()
@@ -1,49 +1,178 @@
 import json
+import secrets
 import logging
 import asyncio
 import datetime as dt
-
-import aiohttp
+from typing import Dict, List, Set
 
 from . import operations as opers
 from .models import SubInfo
 from .setting import Setting
+from . import twitch
+from . import aiodb
+from . import lease
+from . import routing
 
 
 logger = logging.getLogger(__name__)
 HUB_URL = "https://api.twitch.tv/helix/webhooks/hub"
+DEFAULT_RENEW_CONCURRENCY = 10
+DEFAULT_SWEEP_MINUTES = 30
+SECRET_BYTES = 16
 
-async def update_job():
-    sub_list = opers.list_subinfo()
-    now = dt.datetime.now()
-    tasks = list()
-    for sub in sub_list:
-        expired_date = sub.get_expired_date()
-        if now > expired_date:
-            task = asyncio.create_task(update_sub(sub))
-            tasks.append(task)
+# sub-info ids being renewed, so overlapping runs do not renew twice
+_renewing: Set[int] = set()
+
+async def update_job(before: dt.datetime = None) -> Dict[str, int]:
+    """Renew subscriptions expiring until `before`.
+
+    Args:
+        before (dt.datetime, optional):
+            Default: now.
+    Returns:
+        Dict[str, int]:
+            Number of renewed, failed and skipped subscriptions.
+    """
+    before = before or dt.datetime.now()
+    sub_list = await aiodb.run(opers.list_expiring_subinfo, before)
+    if sub_list is None:
+        logger.error("Failed to list expiring subscriptions.")
+        return {"renewed": 0, "failed": 0, "skipped": 0}
 
-    if len(tasks) == 0:
+    if len(sub_list) == 0:
         logger.info("No need to update.")
 
-async def update_sub(sub_info: SubInfo):
+    return await renew_subscriptions(sub_list)
+
+async def sweep_leases() -> Dict[str, int]:
+    """Renew subscriptions the lease scheduler should have renewed already.
+
+    Coarse safety net for leases it never loaded or failed to renew. Run it
+    more often than the lease margin so they are renewed before expiry.
+    """
+    return await update_job(
+        dt.datetime.now() + dt.timedelta(seconds=lease.scheduler.margin))
+
+async def renew_leases(sub_ids: List[int]) -> Dict[str, int]:
+    """Renew subscriptions by id. Renew callback of the lease scheduler."""
+    sub_list = await aiodb.run(opers.list_subinfo_by_ids, sub_ids)
+    if sub_list is None:
+        logger.error("Failed to get subscriptions to renew.")
+        return {"renewed": 0, "failed": 0, "skipped": 0}
+
+    # removed meanwhile
+    for sub_id in set(sub_ids) - {sub.id for sub in sub_list}:
+        lease.scheduler.cancel(sub_id)
+
+    return await renew_subscriptions(sub_list)
+
+async def renew_subscriptions(sub_list: List[SubInfo]) -> Dict[str, int]:
+    """Post renewals to the hub and record accepted ones in one UPDATE.
+
+    Returns:
+        Dict[str, int]:
+            Number of renewed, failed and skipped subscriptions. Skipped
+            ones are already being renewed by another run.
+    """
     setting = Setting.get_instance()
-    sub_body = sub_info.get_sub_body()
-    headers = setting.get_headers()
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
+    summary = {"renewed": 0, "failed": 0, "skipped": 0}
+    due = [sub for sub in sub_list if sub.id not in _renewing]
+    summary["skipped"] = len(sub_list) - len(due)
+    if len(due) == 0:
+        return summary
+
+    due_ids = {sub.id for sub in due}
+    _renewing.update(due_ids)
+    try:
+        # subscriptions made before signed deliveries get a secret now
+        legacy = [sub for sub in due if sub.secret is None]
+        if len(legacy) > 0:
+            await _rotate_secrets(legacy)
+
+        semaphore = asyncio.Semaphore(int(setting.get(
+            "renew_concurrency", DEFAULT_RENEW_CONCURRENCY)))
+
+        async def bounded(sub):
+            async with semaphore:
+                return await update_sub(sub)
+
+        results = await asyncio.gather(*[bounded(sub) for sub in due])
+        refused = [
+            sub for sub, result in zip(due, results)
+            if not result and sub in legacy and sub.secret is not None
+        ]
+        if len(refused) > 0:
+            await _rollback_secrets(refused)
+
+        renewed = [sub for sub, result in zip(due, results) if result]
+        if len(renewed) > 0 and not await aiodb.run(opers.renew_subinfo, renewed):
+            logger.error("Sub-info update failed: {} subscriptions".format(
+                len(renewed)))
+            renewed = []
+
+    finally:
+        _renewing.difference_update(due_ids)
+
+    summary["renewed"] = len(renewed)
+    summary["failed"] = len(due) - len(renewed)
+    logger.info("Renewed subscriptions: {renewed} renewed, {failed} failed, "
+                "{skipped} skipped.".format(**summary))
+
+    return summary
+
+async def _rotate_secrets(sub_list: List[SubInfo]) -> None:
+    """Give subscriptions new secrets before the hub signs with them.
+
+    The secrets are stored first, so a failed renewal record cannot lose
+    them, and unsigned deliveries stay accepted until the renewal is
+    recorded. If storing fails the subscriptions are renewed unsigned.
+    """
+    for sub in sub_list:
+        sub.secret = secrets.token_hex(SECRET_BYTES)
+
+    if not await aiodb.run(opers.save_subinfo_secrets, sub_list):
+        logger.error("Secret update failed: {} subscriptions".format(
+            len(sub_list)))
+        for sub in sub_list:
+            sub.secret = None
+        return
+
+    for sub in sub_list:
+        routing.table.rotate_secret(sub.user_id, sub.id, sub.secret)
+
+async def _rollback_secrets(sub_list: List[SubInfo]) -> None:
+    """Drop new secrets of subscriptions the hub refused to renew."""
+    for sub in sub_list:
+        sub.secret = None
+
+    if not await aiodb.run(opers.save_subinfo_secrets, sub_list):
+        logger.error("Secret rollback failed: {} subscriptions".format(
+            len(sub_list)))
+        return
+
+    for sub in sub_list:
+        routing.table.set_secret(sub.user_id, sub.id, None)
+
+async def update_sub(sub_info: SubInfo) -> bool:
+    """Post a renewal of a subscription to the hub.
+
+    Returns:
+        bool:
+            True if the hub accepted it.
+    """
+    try:
+        status, _ = await twitch.request(
+            "POST",
             HUB_URL,
-            data=json.dumps(sub_body),
-            headers=headers
-        ) as resp:
-            if resp.status == 202:
-                result = opers.update_subinfo(sub_info.id)
+            priority=twitch.BACKGROUND,
+            data=json.dumps(sub_info.get_sub_body()),
+        )
+        if status == 202:
+            return True
 
-            else:
-                logger.error("Failed to update subscription: {}".format(sub_info))
+        logger.error("Failed to update subscription: {}".format(sub_info))
 
-    if result is True:
-        logger.info("Successfully update sub-info: {}".format(sub_info))
+    except Exception as ex:
+        logger.exception(ex)
 
-    else:
-        logger.error("Sub-info update failed: {}".format(sub_info))
+    return False
@@ -6,6 +6,35 @@ class Setting(object):
     _unique_instance = None
     _lock = Lock()
     __setting = {}
+    # optional keys read from the environment when no setting file exists
+    _optional_environ = {
+        "twitch_client_secret": "TWITCH_CLIENT_SECRET",
+        "twitch_token_refresh_margin": "TWITCH_TOKEN_REFRESH_MARGIN",
+        "twitch_limit_per_host": "TWITCH_LIMIT_PER_HOST",
+        "twitch_keepalive": "TWITCH_KEEPALIVE",
+        "twitch_timeout": "TWITCH_TIMEOUT",
+        "twitch_connect_timeout": "TWITCH_CONNECT_TIMEOUT",
+        "twitch_rate_limit": "TWITCH_RATE_LIMIT",
+        "twitch_background_reserve": "TWITCH_BACKGROUND_RESERVE",
+        "twitch_max_retries": "TWITCH_MAX_RETRIES",
+        "discord_send_concurrency": "DISCORD_SEND_CONCURRENCY",
+        "discord_send_retries": "DISCORD_SEND_RETRIES",
+        "webhook_queue_size": "WEBHOOK_QUEUE_SIZE",
+        "webhook_workers": "WEBHOOK_WORKERS",
+        "routing_reconcile_minutes": "ROUTING_RECONCILE_MINUTES",
+        "db_executor_workers": "DB_EXECUTOR_WORKERS",
+        "renew_concurrency": "RENEW_CONCURRENCY",
+        "subscribe_concurrency": "SUBSCRIBE_CONCURRENCY",
+        "lease_margin_seconds": "LEASE_MARGIN_SECONDS",
+        "lease_jitter_seconds": "LEASE_JITTER_SECONDS",
+        "lease_sweep_minutes": "LEASE_SWEEP_MINUTES",
+        "stream_state_size": "STREAM_STATE_SIZE",
+        "resolver_cache_size": "RESOLVER_CACHE_SIZE",
+        "resolver_ttl": "RESOLVER_TTL",
+        "resolver_negative_ttl": "RESOLVER_NEGATIVE_TTL",
+        "trace_sample_rate": "TRACE_SAMPLE_RATE",
+        "trace_slow_seconds": "TRACE_SLOW_SECONDS",
+    }
 
     def __new__(cls):
         raise NotImplementedError('Cannot initialize via Constructor')
@@ -13,6 +42,9 @@ class Setting(object):
     def __getitem__(self, key):
         return self.__setting.get(key, None)
 
+    def get(self, key, default=None):
+        return self.__setting.get(key, default)
+
     @classmethod
     def __internal_new__(cls):
         return super().__new__(cls)
@@ -34,9 +66,16 @@ class Setting(object):
             self.__setting["webhook_host"] = os.environ["WEBHOOK_HOST"]
             self.__setting["discord_token"] = os.environ["DISCORD_TOKEN"]
             self.__setting["twitch_client_id"] = os.environ["TWITCH_CLIENT_ID"]
+            for key, environ in self._optional_environ.items():
+                if environ in os.environ:
+                    self.__setting[key] = os.environ[environ]
 
-    def get_headers(self) -> None:
-        return {
+    def get_headers(self, token=None) -> dict:
+        headers = {
             "Content-Type": "application/json",
             "Client-ID": self.__setting["twitch_client_id"]
         }
+        if token is not None:
+            headers["Authorization"] = "Bearer {}".format(token)
+
+        return headers
@@ -0,0 +1,66 @@
+import hmac
+import hashlib
+import logging
+from typing import Dict, Iterable, Optional
+
+
+logger = logging.getLogger(__name__)
+HEADER = "X-Hub-Signature"
+ALGORITHM = "sha256"
+MAX_BODY_SIZE = 65536 # bytes
+
+stats: Dict[str, int] = {
+    "verified": 0,
+    "unsigned": 0,
+    "rejected": 0,
+}
+
+def sign(body: bytes, secret: str) -> str:
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+    return "{}={}".format(ALGORITHM, digest)
+
+def verify(
+    body: bytes,
+    header: Optional[str],
+    secrets: Iterable[Optional[str]],
+) -> bool:
+    """Verify the X-Hub-Signature of a webhook delivery.
+
+    Deliveries are accepted unsigned only while the streamer has a
+    subscription made without a secret.
+
+    Args:
+        body (bytes):
+            Raw request body.
+        header (Optional[str]):
+            X-Hub-Signature header, `sha256=<hex digest>`.
+        secrets (Iterable[Optional[str]]):
+            Secrets of the streamer's subscriptions.
+    Returns:
+        bool:
+            True if the delivery is authentic.
+    """
+    secrets = list(secrets)
+    if len(secrets) == 0 or len(body) > MAX_BODY_SIZE:
+        stats["rejected"] += 1
+        return False
+
+    if header is None and None in secrets:
+        stats["unsigned"] += 1
+        return True
+
+    algorithm, _, signature = (header or "").partition("=")
+    if algorithm != ALGORITHM or len(signature) != hashlib.sha256().digest_size * 2:
+        stats["rejected"] += 1
+        return False
+
+    for secret in secrets:
+        if secret is not None and hmac.compare_digest(
+                sign(body, secret), header):
+            stats["verified"] += 1
+            return True
+
+    stats["rejected"] += 1
+
+    return False
@@ -0,0 +1,115 @@
+import logging
+from collections import OrderedDict
+from typing import Dict
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_MAXSIZE = 4096
+
+ONLINE = "online"
+OFFLINE = "offline"
+UPDATE = "update"
+DUPLICATE = "duplicate"
+
+
+class StreamStateStore(object):
+    """Last known stream state per streamer, to classify webhook events.
+
+    Holds stream id, started_at, title and game of each streamer in an
+    LRU-bounded map. A streamer evicted or never seen is treated as unknown,
+    so its next event is always delivered.
+
+    Args:
+        maxsize (int):
+            Max number of streamers to remember.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.counts: Dict[str, int] = {
+            ONLINE: 0, OFFLINE: 0, UPDATE: 0, DUPLICATE: 0,
+        }
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, user_id) -> Dict[str, str]:
+        return self._states.get(str(user_id), None)
+
+    def classify(self, user_id, received_data: dict) -> str:
+        """Classify an event against the last recorded state.
+
+        The new state is not remembered until `record`, so an event that
+        fails to be delivered is classified the same way next time.
+
+        Args:
+            user_id (str):
+                Twitch UserID of the streamer.
+            received_data (dict):
+                Webhook payload of the streams topic.
+        Returns:
+            str:
+                ONLINE, OFFLINE, UPDATE or DUPLICATE.
+        """
+        previous = self._states.get(str(user_id), None)
+        state = _state(received_data)
+        if state["status"] == OFFLINE:
+            if previous is not None and previous["status"] == OFFLINE:
+                event = DUPLICATE
+
+            else:
+                event = OFFLINE
+
+        elif (
+            previous is None
+            or previous["status"] == OFFLINE
+            or previous["id"] != state["id"]
+            or previous["started_at"] != state["started_at"]
+        ):
+            event = ONLINE
+
+        elif (
+            previous["title"] != state["title"]
+            or previous["game_id"] != state["game_id"]
+        ):
+            event = UPDATE
+
+        else:
+            event = DUPLICATE
+
+        self.counts[event] += 1
+
+        return event
+
+    def record(self, user_id, received_data: dict) -> None:
+        """Remember the state of a delivered event.
+
+        Args:
+            user_id (str):
+                Twitch UserID of the streamer.
+            received_data (dict):
+                Webhook payload of the streams topic.
+        """
+        user_id = str(user_id)
+        self._states[user_id] = _state(received_data)
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+
+
+def _state(received_data: dict) -> Dict[str, str]:
+    if len(received_data["data"]) == 0:
+        return {"status": OFFLINE}
+
+    stream = received_data["data"][0]
+
+    return {
+        "status": ONLINE,
+        "id": stream.get("id"),
+        "started_at": stream.get("started_at"),
+        "title": stream.get("title"),
+        "game_id": stream.get("game_id"),
+    }
+
+states = StreamStateStore()
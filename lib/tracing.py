@@ -0,0 +1,212 @@
+import time
+import random
+import logging
+import functools
+import contextvars
+from typing import Any, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+# dedicated log of slow traces, see main for its handler
+slow_logger = logging.getLogger("slow")
+slow_logger.propagate = False
+DEFAULT_SAMPLE_RATE = 0.0 # opt-in
+DEFAULT_SLOW_SECONDS = 10.0
+
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+
+
+class Span(object):
+    __slots__ = ("name", "attrs", "start", "end", "children", "trace")
+
+    def __init__(self, name: str, attrs: Dict[str, Any], trace: "Trace"):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+        self.children: List[Span] = []
+        self.trace = trace
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def format(self, origin: float, depth: int = 0) -> List[str]:
+        attrs = "".join(
+            " {}={}".format(key, value) for key, value in self.attrs.items())
+        lines = ["{}{} +{:.3f}s {:.3f}s{}".format(
+            "  " * depth, self.name, self.start - origin, self.duration, attrs)]
+        for child in self.children:
+            lines.extend(child.format(origin, depth + 1))
+
+        return lines
+
+
+class Trace(object):
+    __slots__ = ("root", "open")
+
+    def __init__(self):
+        self.root = None
+        # the trace is complete when its last span ends
+        self.open = 0
+
+
+class _SpanContext(object):
+    __slots__ = ("tracer", "span", "token")
+
+    def __init__(self, tracer: "Tracer", span: Span):
+        self.tracer = tracer
+        self.span = span
+
+    def __enter__(self) -> Span:
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *args):
+        _current.reset(self.token)
+        self.tracer.end(self.span)
+
+
+class _NoopContext(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        pass
+
+
+_NOOP = _NoopContext()
+
+
+class Tracer(object):
+    """Sampled span tracing of webhook events.
+
+    A trace is started for a sampled share of events. Spans opened while
+    it is the current context become its children, across awaits and
+    `aiodb.run`. Unsampled events only pay a context variable lookup per
+    span. Traces longer than `slow_seconds` are written to the slow log
+    with their full span tree.
+
+    Args:
+        sample_rate (float):
+            Share of events to trace, 0 disables tracing.
+        slow_seconds (float):
+            Traces taking longer are logged.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = DEFAULT_SAMPLE_RATE,
+        slow_seconds: float = DEFAULT_SLOW_SECONDS,
+    ):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.sampled = 0
+        self.slow = 0
+
+    def trace(self, name: str, **attrs):
+        """Start a trace of a sampled event, a no-op for the others."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return _NOOP
+
+        self.sampled += 1
+        trace = Trace()
+        trace.root = self._start(name, attrs, trace)
+
+        return _SpanContext(self, trace.root)
+
+    def span(self, name: str, **attrs):
+        """Open a child span of the current one, a no-op outside traces."""
+        parent = _current.get()
+        if parent is None:
+            return _NOOP
+
+        span = self._start(name, attrs, parent.trace)
+        parent.children.append(span)
+
+        return _SpanContext(self, span)
+
+    def hold(self, name: str, **attrs) -> Optional[Span]:
+        """Open a child span ended later by `end`, for work handed off.
+
+        The trace stays open until it ends, so work picked up from a queue
+        is still part of it.
+        """
+        parent = _current.get()
+        if parent is None:
+            return None
+
+        span = self._start(name, attrs, parent.trace)
+        parent.children.append(span)
+
+        return span
+
+    def _start(self, name: str, attrs: Dict[str, Any], trace: Trace) -> Span:
+        trace.open += 1
+
+        return Span(name, attrs, trace)
+
+    def end(self, span: Optional[Span]) -> None:
+        if span is None or span.end is not None:
+            return
+
+        span.end = time.perf_counter()
+        trace = span.trace
+        trace.open -= 1
+        if trace.open == 0:
+            self._finish(trace)
+
+    def _finish(self, trace: Trace) -> None:
+        # the root may end before work it handed off
+        end = max(_last_end(trace.root), trace.root.end)
+        duration = end - trace.root.start
+        if duration < self.slow_seconds:
+            return
+
+        self.slow += 1
+        slow_logger.warning("Slow {} {:.3f}s\n{}".format(
+            trace.root.name, duration,
+            "\n".join(trace.root.format(trace.root.start))))
+
+    def stats(self) -> Dict[str, int]:
+        return {"sampled": self.sampled, "slow": self.slow}
+
+
+def _last_end(span: Span) -> float:
+    return max([span.end] + [_last_end(child) for child in span.children])
+
+def traced(name: str):
+    """Decorate a coroutine function to run in a span of its own."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def traced_event(name: str):
+    """Decorate a coroutine function to start a trace of each sampled call."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.trace(name, **kwargs_attrs(kwargs)):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def kwargs_attrs(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    # plain keyword arguments such as route parameters, not sessions
+    return {
+        key: value for key, value in kwargs.items()
+        if isinstance(value, (str, int, float))
+    }
+
+
+tracer = Tracer()
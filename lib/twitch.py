@@ -0,0 +1,227 @@
+import json
+import logging
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+import aiohttp
+
+from .setting import Setting
+from . import ratelimit
+from . import auth
+from . import metrics
+from . import tracing
+from .ratelimit import NOTIFY, INTERACTIVE, BACKGROUND
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_LIMIT_PER_HOST = 10
+DEFAULT_TIMEOUT = 10 # seconds
+DEFAULT_CONNECT_TIMEOUT = 5 # seconds
+DEFAULT_KEEPALIVE = 60 # seconds
+USERS_API = "https://api.twitch.tv/helix/users"
+USERS_PER_REQUEST = 100
+DEFAULT_MAX_RETRIES = 2
+
+_session: Optional[aiohttp.ClientSession] = None
+_bucket: Optional[ratelimit.TokenBucket] = None
+
+def _create_session() -> aiohttp.ClientSession:
+    setting = Setting.get_instance()
+    connector = aiohttp.TCPConnector(
+        limit_per_host=int(setting.get(
+            "twitch_limit_per_host", DEFAULT_LIMIT_PER_HOST)),
+        keepalive_timeout=float(setting.get(
+            "twitch_keepalive", DEFAULT_KEEPALIVE)),
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=float(setting.get("twitch_timeout", DEFAULT_TIMEOUT)),
+        connect=float(setting.get(
+            "twitch_connect_timeout", DEFAULT_CONNECT_TIMEOUT)),
+    )
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def get_session() -> aiohttp.ClientSession:
+    """Get the shared Twitch HTTP session.
+
+    The session is created lazily on first use, so callers outside of the
+    application lifecycle (tests, scripts) can use it without `start()`.
+
+    Returns:
+        aiohttp.ClientSession:
+            Keep-alive session shared by all Twitch API calls.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+
+    return _session
+
+def get_bucket() -> ratelimit.TokenBucket:
+    """Get the token bucket shared by all Helix calls."""
+    global _bucket
+    if _bucket is None:
+        setting = Setting.get_instance()
+        _bucket = ratelimit.TokenBucket(
+            capacity=int(setting.get(
+                "twitch_rate_limit", ratelimit.DEFAULT_CAPACITY)),
+            reserve=float(setting.get(
+                "twitch_background_reserve", ratelimit.DEFAULT_RESERVE)),
+        )
+
+    return _bucket
+
+async def request(
+    method: str,
+    url: str,
+    priority: int = BACKGROUND,
+    **kwargs,
+) -> Tuple[int, Any]:
+    """Call a Helix or Hub endpoint within the rate limit.
+
+    The call waits for a token of the shared bucket in its priority class
+    and syncs the bucket to the Ratelimit headers of the response. A 429 is
+    retried once the bucket allows it. With a client secret configured the
+    call is authorized with the app access token, and a 401 is retried
+    once with a new token.
+
+    Args:
+        method (str):
+            HTTP method.
+        url (str):
+            Request URL.
+        priority (int, optional):
+            NOTIFY for go-live notifications, INTERACTIVE for bot commands,
+            BACKGROUND for renewals and cache warming.
+            Default: BACKGROUND.
+        **kwargs:
+            Passed to aiohttp.ClientSession.request.
+    Returns:
+        Tuple[int, Any]:
+            Response status and JSON body, None for an empty body.
+    """
+    endpoint = _endpoint(url)
+    with metrics.helix_seconds.labels(endpoint).time(), \
+            tracing.tracer.span("helix", endpoint=endpoint):
+        try:
+            status, body = await _request(method, url, priority, **kwargs)
+
+        except Exception:
+            metrics.helix_failures.labels(endpoint).inc()
+            raise
+
+    if status >= 400:
+        metrics.helix_failures.labels(endpoint).inc()
+
+    return status, body
+
+def _endpoint(url: str) -> str:
+    # "https://api.twitch.tv/helix/users?login=x" -> "helix/users"
+    return url.split("?", 1)[0].rsplit("twitch.tv/", 1)[-1]
+
+async def _request(
+    method: str,
+    url: str,
+    priority: int,
+    **kwargs,
+) -> Tuple[int, Any]:
+    setting = Setting.get_instance()
+    bucket = get_bucket()
+    max_retries = int(setting.get("twitch_max_retries", DEFAULT_MAX_RETRIES))
+    attempt = 0
+    reauthorized = False
+    while True:
+        token = await auth.app_token.get(get_session())
+        await bucket.acquire(priority)
+        async with get_session().request(
+            method, url, headers=setting.get_headers(token), **kwargs
+        ) as resp:
+            bucket.sync(resp.headers)
+            if resp.status == 401 and token is not None and not reauthorized:
+                # expired or revoked before we refreshed it
+                logger.warning("App access token refused: {}".format(url))
+                auth.app_token.invalidate(token)
+                reauthorized = True
+                continue
+
+            if resp.status == 429 and attempt < max_retries:
+                logger.warning("Rate limited by Twitch: {}".format(url))
+                attempt += 1
+                continue
+
+            body = await resp.text()
+
+            return resp.status, json.loads(body) if body else None
+
+async def start() -> None:
+    """Open the shared session. Called on application startup."""
+    get_session()
+    logger.info("Twitch HTTP client started.")
+
+async def close() -> None:
+    """Close the shared session. Called on application shutdown."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("Twitch HTTP client closed.")
+
+    _session = None
+
+async def lookup_users(
+    logins: Iterable[str],
+    priority: int = BACKGROUND,
+) -> Tuple[Dict[str, dict], Set[str]]:
+    """Look up Twitch users by login with batched helix/users calls.
+
+    Args:
+        logins (Iterable[str]):
+            Twitch Login Names. Up to 100 are sent per request.
+        priority (int, optional):
+            Priority class of the requests.
+            Default: BACKGROUND.
+    Returns:
+        Tuple[Dict[str, dict], Set[str]]:
+            helix/users entries by lowercase login, and lowercase logins
+            Helix does not know. Logins of failed requests are in neither.
+    """
+    names = sorted({login.lower() for login in logins if login})
+    users = dict()
+    unknown = set()
+    for i in range(0, len(names), USERS_PER_REQUEST):
+        chunk = names[i:i + USERS_PER_REQUEST]
+        try:
+            status, json_body = await request(
+                "GET",
+                USERS_API,
+                priority=priority,
+                params=[("login", name) for name in chunk],
+            )
+
+        except Exception as ex:
+            logger.exception(ex)
+            continue
+
+        if status != 200:
+            logger.error("Failed to look up users: {}".format(status))
+            continue
+
+        for user in (json_body or {}).get("data", []):
+            users[user["login"].lower()] = user
+
+        unknown.update(name for name in chunk if name not in users)
+
+    return users, unknown
+
+async def get_users(
+    logins: Iterable[str],
+    priority: int = BACKGROUND,
+) -> Dict[str, dict]:
+    """Look up Twitch users by login, see `lookup_users`.
+
+    Returns:
+        Dict[str, dict]:
+            helix/users entries by lowercase login. Unknown logins and
+            logins of failed requests are missing.
+    """
+    users, _ = await lookup_users(logins, priority=priority)
+
+    return users
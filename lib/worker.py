@@ -0,0 +1,170 @@
+import time
+import asyncio
+import logging
+import contextvars
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List
+
+from . import metrics
+from . import tracing
+
+
+logger = logging.getLogger(__name__)
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_WORKERS = 4
+DEFAULT_DRAIN_TIMEOUT = 10 # seconds
+
+
+class WebhookQueue(object):
+    """Bounded in-process queue drained by a pool of worker coroutines.
+
+    Args:
+        handler (Callable[..., Awaitable[Any]]):
+            Coroutine function called with the queued arguments.
+        maxsize (int):
+            Max number of queued items. `put` refuses items beyond it.
+        workers (int):
+            Number of worker coroutines.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[Any]],
+        maxsize: int = DEFAULT_QUEUE_SIZE,
+        workers: int = DEFAULT_WORKERS,
+    ):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._queue = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return len(self._tasks) > 0
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(self.workers)
+        ]
+        logger.info("Started {} webhook workers.".format(self.workers))
+
+    def put(self, *args) -> bool:
+        """Queue a handler call without waiting.
+
+        Returns:
+            bool:
+                False if the queue is not running or full.
+        """
+        if not self.running:
+            return False
+
+        # the wait in the queue is part of a sampled trace
+        held = tracing.tracer.hold("queue")
+        try:
+            self._queue.put_nowait(
+                (time.monotonic(), contextvars.copy_context(), held, args))
+
+        except asyncio.QueueFull:
+            tracing.tracer.end(held)
+            self.rejected += 1
+            logger.error("Webhook queue is full: {} items.".format(self.maxsize))
+            return False
+
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            queued_at, context, held, args = await self._queue.get()
+            wait = time.monotonic() - queued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                if held is None:
+                    await self.handler(*args)
+
+                else:
+                    # continue the trace in the context of the webhook
+                    await context.run(asyncio.ensure_future, self._traced(held, args))
+
+            except Exception as ex:
+                self.failed += 1
+                logger.exception(ex)
+
+            finally:
+                self.processed += 1
+                self._queue.task_done()
+                metrics.webhook_seconds.labels("queued").observe(
+                    time.monotonic() - queued_at)
+
+    async def _traced(self, held: tracing.Span, args: tuple) -> None:
+        with tracing.tracer.span("process"):
+            tracing.tracer.end(held)
+            await self.handler(*args)
+
+    async def drain(self, timeout: float = DEFAULT_DRAIN_TIMEOUT) -> None:
+        """Wait for queued items to finish, then stop the workers."""
+        if not self.running:
+            return
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+
+        except asyncio.TimeoutError:
+            logger.error("Webhook queue drain timed out: {} items left.".format(
+                self._queue.qsize()))
+
+        for task in self._tasks:
+            task.cancel()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Stopped webhook workers.")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class KeyedLock(object):
+    """One asyncio.Lock per key, dropped when nobody holds or waits for it.
+
+    Serializes handler calls of the same key while calls of other keys run
+    concurrently on the other workers.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Any, asyncio.Lock] = {}
+        self._holders: Dict[Any, int] = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: Any):
+        lock = self._locks.get(key, None)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+
+        finally:
+            self._holders[key] -= 1
+            if self._holders[key] == 0:
+                del self._holders[key]
+                del self._locks[key]
@@ -2,26 +2,44 @@ import sys
 import json
 import logging
 import asyncio
+import secrets
 import argparse
+import time
+import textwrap
 
-import aiohttp
 import discord
 import responder
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from lib.models import init_db
+from lib.models import init_db, migrate_db
 from lib.setting import Setting
-from lib.scheduler import update_job
+from lib.scheduler import renew_leases, sweep_leases, DEFAULT_SWEEP_MINUTES
 from lib import operations as opers
 from lib import embed
+from lib import dispatcher
+from lib import worker
+from lib import routing
+from lib import lease
+from lib import streamstate
+from lib import signature
+from lib import announcements
+from lib import twitch
+from lib import ratelimit
+from lib import auth
+from lib import resolver
 from lib import db
+from lib import aiodb
+from lib import metrics
+from lib import tracing
 
 
-TWITCH_ID_URL = "https://api.twitch.tv/helix/users?login={}"
 HUB_TOPIC_URL = "https://api.twitch.tv/helix/streams?user_id={}"
 HUB_URL = "https://api.twitch.tv/helix/webhooks/hub"
 LEASE_SECONDS = 864000
-UPDATE_TICKS = 60 # minutes
+SECRET_BYTES = 16
+DEFAULT_SUBSCRIBE_CONCURRENCY = 10
+DISCORD_MESSAGE_LIMIT = 2000
+RECONCILE_RETRY_SECONDS = 30
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -31,6 +49,10 @@ fhandler = logging.FileHandler("./log", encoding="utf-8", mode="a")
 fhandler.setLevel(logging.INFO)
 logger.addHandler(handler)
 logger.addHandler(fhandler)
+# span trees of slow webhooks, kept out of the main log
+shandler = logging.FileHandler(
+    "./slow_log", encoding="utf-8", mode="a", delay=True)
+tracing.slow_logger.addHandler(shandler)
 
 # -- Settings -----------------------------------------------------------------
 api = responder.API()
@@ -38,26 +60,142 @@ client = discord.Client()
 setting = Setting.get_instance()
 
 # -- Subscriber ---------------------------------------------------------------
+async def update_announcement(user_id, data) -> bool:
+    announcement = announcements.store.get(user_id)
+    if announcement is None:
+        logger.info("No announcement to update: {}".format(user_id))
+        return False
+
+    stream = data["data"][0]
+    await embed.update_embed(
+        announcement.embed, announcement.title, announcement.game_id, data)
+    announcement.title = stream["title"]
+    announcement.game_id = stream["game_id"]
+    await dispatcher.get_dispatcher().edit(
+        announcement.messages, announcement.content, announcement.embed)
+
+    return True
+
+async def process_webhook(user_id, data, session=None):
+    # one event of a streamer at a time, so an update or offline event
+    # sees the announcement of the go-live still being sent
+    async with webhook_locks.hold(str(user_id)):
+        await deliver_event(user_id, data, session=session)
+        # a failed go-live is announced on the next event of the stream
+        streamstate.states.record(user_id, data)
+
+async def deliver_event(user_id, data, session=None):
+    # drop retries
+    event = streamstate.states.classify(user_id, data)
+    metrics.webhook_events.labels(event).inc()
+    if event == streamstate.DUPLICATE:
+        logger.info("Skip {} event: {}".format(event, user_id))
+        return
+
+    # edit announcements instead of posting new messages,
+    # announce the stream if its go-live was never sent
+    if event == streamstate.UPDATE:
+        if await update_announcement(user_id, data):
+            return
+
+    if event == streamstate.OFFLINE:
+        announcement = announcements.store.pop(user_id)
+        if announcement is not None:
+            content, _ = await embed.get_message(announcement.user_name, data)
+            await dispatcher.get_dispatcher().edit(
+                announcement.messages, content, announcement.embed)
+            return
+
+    # get discord channels by twitch user id
+    with tracing.tracer.span("routing"):
+        targets = routing.table.get_targets(str(user_id))
+        if targets is None:
+            rows = await aiodb.run(
+                opers.get_delivery_targets, str(user_id), session=session) or []
+            targets = [(user.user_name, channel_id) for user, channel_id in rows]
+
+    if len(targets) == 0:
+        logger.error("No delivery targets: {}".format(user_id))
+        return
+
+    # build message once and share it with all guilds
+    content, embed_obj = await embed.get_message(targets[0][0], data)
+
+    # post on all guilds
+    channels = list()
+    for _, channel_id in targets:
+        channel = client.get_channel(int(channel_id))
+        if channel is None:
+            logger.error("Faild to get channel: {}".format(channel_id))
+            continue
+
+        channels.append(channel)
+
+    report = await dispatcher.get_dispatcher().dispatch(
+        channels, content, embed_obj)
+
+    if event in (streamstate.ONLINE, streamstate.UPDATE):
+        stream = data["data"][0]
+        announcements.store.add(user_id, announcements.Announcement(
+            user_name=targets[0][0],
+            stream_id=stream.get("id"),
+            title=stream.get("title"),
+            game_id=stream.get("game_id"),
+            content=content,
+            embed=embed_obj,
+            messages=report["messages"],
+        ))
+
+webhook_queue = worker.WebhookQueue(process_webhook)
+webhook_locks = worker.KeyedLock()
+
 @api.route("/webhook/{user_id}")
-async def handle_webhooks(req, resp, *, user_id, session=db.session):
+@tracing.traced_event("webhook")
+async def handle_webhooks(req, resp, *, user_id, session=None):
     try:
         if req.method == "post":
-            # get discord channel by twitch user id
-            data = await req.media()
-            users = opers.get_users(str(user_id), session=session)
-            guilds = [client.get_guild(int(user.guild_id)) for user in users]
+            received = time.perf_counter()
+            # verify before parsing, secrets are kept in memory
+            with tracing.tracer.span("verify"):
+                sub_secrets = routing.table.get_secrets(str(user_id))
+                if sub_secrets is None:
+                    sub_secrets = (await aiodb.run(
+                        opers.list_secrets, str(user_id), session=session) or {}).values()
+
+                body = await req.content
+                verified = signature.verify(
+                    body, req.headers.get(signature.HEADER), sub_secrets)
+
+            if not verified:
+                resp.status_code = 403
+                resp.text = "Invalid signature."
+                metrics.webhook_rejected.labels("signature").inc()
+                return
+
+            with tracing.tracer.span("parse"):
+                try:
+                    data = json.loads(body)
 
-            # post on all guilds
-            for guild, user in zip(guilds, users):
-                channel = opers.get_channel(guild.id, session=session)
+                except ValueError:
+                    data = None
 
-                if channel is None:
-                    logger.error("Faild to get channel.")
-                    return
+            if not isinstance(data, dict) or not isinstance(data.get("data"), list):
+                resp.status_code = 400
+                resp.text = "Invalid payload."
+                metrics.webhook_rejected.labels("payload").inc()
+                return
+
+            if not webhook_queue.running:
+                # no workers outside of the server lifecycle
+                await process_webhook(user_id, data, session=session)
+                metrics.webhook_seconds.labels("inline").observe(
+                    time.perf_counter() - received)
 
-                channel = client.get_channel(int(channel.channel_id))
-                content, embed_obj = await embed.get_message(user.user_name, data)
-                await channel.send(content=content, embed=embed_obj)
+            elif not webhook_queue.put(user_id, data):
+                # let Twitch retry later
+                resp.status_code = 503
+                resp.text = "Busy."
+                metrics.webhook_rejected.labels("busy").inc()
 
         elif req.method == "get":
             challenge = req.params.get("hub.challenge")
@@ -70,6 +208,93 @@ async def handle_webhooks(req, resp, *, user_id, session=db.session):
         resp.text = str(ex)
         raise ex
 
+@api.route("/metrics")
+async def handle_metrics(req, resp):
+    resp.text = metrics.render()
+    resp.mimetype = metrics.CONTENT_TYPE
+
+def _cache_requests():
+    values = dict()
+    for name, cache in (
+        ("game", embed.game_cache), ("thumbnail", embed.thumbnail_cache)
+    ):
+        stats = cache.stats()
+        values[(name, "hit")] = stats["hits"]
+        values[(name, "coalesced")] = stats["coalesced"]
+        values[(name, "miss")] = stats["misses"]
+
+    stats = resolver.resolver.stats()
+    values[("login", "hit")] = stats["local"] + stats["cached"] + stats["negative"]
+    values[("login", "miss")] = stats["remote"]
+
+    return values
+
+def _helix_bucket():
+    stats = twitch.get_bucket().stats()
+
+    return {
+        ("tokens",): stats["tokens"],
+        ("capacity",): stats["capacity"],
+        ("queued",): stats["queued"],
+    }
+
+def _helix_waits():
+    stats = twitch.get_bucket().stats()
+    values = dict()
+    for name in ratelimit.PRIORITY_NAMES.values():
+        values[(name, "avg")] = stats[name]["avg_wait"]
+        values[(name, "max")] = stats[name]["max_wait"]
+
+    return values
+
+metrics.Collector(
+    "cache_requests_total", "Cache lookups by result.", "counter",
+    _cache_requests, ["cache", "result"])
+metrics.Collector(
+    "helix_rate_limit", "Helix token bucket state.", "gauge",
+    _helix_bucket, ["state"])
+metrics.Collector(
+    "helix_rate_limit_wait_seconds", "Helix token bucket queue wait by priority.",
+    "gauge", _helix_waits, ["priority", "stat"])
+metrics.Collector(
+    "webhook_traces_total", "Sampled webhook traces, and those over the slow threshold.",
+    "counter", lambda: {(name,): value for name, value in tracing.tracer.stats().items()},
+    ["result"])
+metrics.Collector(
+    "webhook_queue_depth", "Webhooks waiting for a worker.", "gauge",
+    lambda: {(): webhook_queue.stats()["depth"]})
+metrics.Collector(
+    "db_pool", "DB connection pool state.", "gauge",
+    lambda: {(key,): value for key, value in db.pool_stats().items()}, ["state"])
+
+# one-off startup tasks, referenced until done so they are not collected
+background_tasks = set()
+
+def start_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    return task
+
+async def reconcile() -> bool:
+    users = await aiodb.run(opers.list_all_users)
+    channels = await aiodb.run(opers.list_channels)
+    sub_list = await aiodb.run(opers.list_subinfo)
+    if users is None or channels is None or sub_list is None:
+        logger.error("Failed to load routing table and leases.")
+        return False
+
+    routing.table.load(users, channels, sub_list)
+    lease.scheduler.load(sub_list)
+
+    return True
+
+async def reconcile_until_loaded():
+    # no lease is renewed until they are loaded once
+    while not await reconcile():
+        await asyncio.sleep(RECONCILE_RETRY_SECONDS)
+
 @api.on_event("startup")
 async def start_discord_bot():
     # Startup discord bot in running loop
@@ -77,11 +302,76 @@ async def start_discord_bot():
     client.loop = loop
     asyncio.create_task(client.start(setting["discord_token"]))
 
-    # Startup background update job
+    # Open shared Twitch HTTP client
+    auth.app_token.margin = float(setting.get(
+        "twitch_token_refresh_margin", auth.DEFAULT_REFRESH_MARGIN))
+    await twitch.start()
+
+    # Startup subscription renewal right before leases expire
+    lease.scheduler.margin = float(setting.get(
+        "lease_margin_seconds", lease.DEFAULT_MARGIN))
+    lease.scheduler.jitter = float(setting.get(
+        "lease_jitter_seconds", lease.DEFAULT_JITTER))
+    lease.scheduler.start(renew_leases)
+
+    # Load webhook routing table and leases, retry in background on failure
+    if not await reconcile():
+        start_background(reconcile_until_loaded())
+
+    # Startup webhook workers
+    webhook_queue.maxsize = int(setting.get(
+        "webhook_queue_size", worker.DEFAULT_QUEUE_SIZE))
+    webhook_queue.workers = int(setting.get(
+        "webhook_workers", worker.DEFAULT_WORKERS))
+    webhook_queue.start()
+
+    streamstate.states.maxsize = int(setting.get(
+        "stream_state_size", streamstate.DEFAULT_MAXSIZE))
+
+    # Sampled tracing of webhooks, off by default
+    tracing.tracer.sample_rate = float(setting.get(
+        "trace_sample_rate", tracing.DEFAULT_SAMPLE_RATE))
+    tracing.tracer.slow_seconds = float(setting.get(
+        "trace_slow_seconds", tracing.DEFAULT_SLOW_SECONDS))
+
+    # Login resolution caches of /add and /remove
+    resolver.resolver.cache.maxsize = int(setting.get(
+        "resolver_cache_size", resolver.DEFAULT_CACHE_SIZE))
+    resolver.resolver.negative_cache.maxsize = resolver.resolver.cache.maxsize
+    resolver.resolver.cache.ttl = float(setting.get(
+        "resolver_ttl", resolver.DEFAULT_TTL))
+    resolver.resolver.negative_cache.ttl = float(setting.get(
+        "resolver_negative_ttl", resolver.DEFAULT_NEGATIVE_TTL))
+
+    # Warm profile image cache for registered users
+    user_names = await aiodb.run(opers.list_user_names)
+    if user_names:
+        start_background(embed.warm_user_thumbnails(user_names))
+
+    # Startup background jobs
     scheduler = AsyncIOScheduler(event_loop=loop)
-    scheduler.add_job(update_job, "interval", minutes=UPDATE_TICKS)
+    sweep_minutes = int(setting.get("lease_sweep_minutes", DEFAULT_SWEEP_MINUTES))
+    if sweep_minutes > 0:
+        # renew leases the lease scheduler missed
+        scheduler.add_job(sweep_leases, "interval", minutes=sweep_minutes)
+
+    reconcile_minutes = int(setting.get("routing_reconcile_minutes", 0))
+    if reconcile_minutes > 0:
+        # pick up changes made by other processes
+        scheduler.add_job(reconcile, "interval", minutes=reconcile_minutes)
+
     scheduler.start()
 
+@api.on_event("shutdown")
+async def stop_discord_bot():
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await lease.scheduler.stop()
+    await webhook_queue.drain()
+    await twitch.close()
+    aiodb.shutdown()
+
 # -- Discord Bot --------------------------------------------------------------
 
 @client.event
@@ -101,97 +391,200 @@ async def on_message(message):
     if message.content.startswith("/set_channel"):
         await set_channel(message)
 
-async def do_subscribe(message):
-    parsed = message.content.strip().split()
-    if len(parsed) != 2:
-        await message.channel.send("Format: /add <twitch_username>")
-        return
-
-    twitch_name = parsed[-1]
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            TWITCH_ID_URL.format(twitch_name),
-            headers=setting.get_headers()
-        ) as resp:
-            json_body = await resp.json()
-            if len(json_body["data"]) == 0:
-                await message.channel.send("No such user: {}".format(twitch_name))
-                return
-
-            user_id = json_body["data"][0]["id"]
-
-    sub_body = {
+def get_sub_body(user_id):
+    return {
         "hub.callback": setting["webhook_host"] + user_id,
         "hub.mode": "subscribe",
         "hub.topic": HUB_TOPIC_URL.format(user_id),
         "hub.lease_seconds": LEASE_SECONDS,
+        "hub.secret": secrets.token_hex(SECRET_BYTES),
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            HUB_URL,
-            data=json.dumps(sub_body),
-            headers=setting.get_headers()
-        ) as resp:
-            if resp.status == 202:
-                result = opers.add_user(
-                    user_id=user_id,
-                    user_name=twitch_name,
-                    guild_id=message.channel.guild.id,
-                    sub_body=sub_body,
+
+async def post_hub(sub_bodies):
+    """Post hub requests with bounded concurrency.
+
+    Returns:
+        List[int]:
+            Response status of each request. None if it raised.
+    """
+    semaphore = asyncio.Semaphore(int(setting.get(
+        "subscribe_concurrency", DEFAULT_SUBSCRIBE_CONCURRENCY)))
+
+    async def post(sub_body):
+        async with semaphore:
+            try:
+                status, _ = await twitch.request(
+                    "POST",
+                    HUB_URL,
+                    priority=twitch.INTERACTIVE,
+                    data=json.dumps(sub_body),
                 )
+                return status
 
-            else:
-                result = False
+            except Exception as ex:
+                logger.exception(ex)
+                return None
 
-            if result:
-                await message.channel.send("Successfully Added!")
+    return await asyncio.gather(*[post(sub_body) for sub_body in sub_bodies])
 
-            else:
-                await message.channel.send(
-                    "Add Error With Response: {}".format(resp.status))
+async def send_summary(channel, title, logins, results):
+    # group logins by result, split only when exceeding the discord limit
+    grouped = dict()
+    for login in logins:
+        grouped.setdefault(results[login], []).append(login)
 
-async def do_unsubscribe(message):
+    lines = [title]
+    for result, names in grouped.items():
+        lines.extend(textwrap.wrap(
+            "[{}] {}".format(result, ", ".join(names)), DISCORD_MESSAGE_LIMIT))
+
+    chunk = ""
+    for line in lines:
+        if chunk and len(chunk) + len(line) + 1 > DISCORD_MESSAGE_LIMIT:
+            await channel.send(chunk)
+            chunk = ""
+
+        chunk = line if not chunk else chunk + "\n" + line
+
+    await channel.send(chunk)
+
+def parse_logins(message):
     parsed = message.content.strip().split()
-    if len(parsed) != 2:
-        await message.channel.send("Format: /remove <twitch_username>")
+
+    return list(dict.fromkeys(name.lower() for name in parsed[1:]))
+
+async def do_subscribe(message):
+    logins = parse_logins(message)
+    if len(logins) == 0:
+        await message.channel.send(
+            "Format: /add <twitch_username> [<twitch_username> ...]")
         return
 
-    twitch_name = parsed[-1]
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            TWITCH_ID_URL.format(twitch_name),
-            headers=setting.get_headers()
-        ) as resp:
-            json_body = await resp.json()
-            if len(json_body["data"]) == 0:
-                await message.channel.send("No such user: {}".format(twitch_name))
-                return
+    users = await resolver.resolver.resolve(logins, priority=twitch.INTERACTIVE)
+    results = {
+        login: "No such user" for login in logins if login not in users}
+    found = [users[login] for login in logins if login in users]
+    for user in found:
+        if "profile_image_url" in user:
+            embed.thumbnail_cache.set(user["login"].lower(), user["profile_image_url"])
+
+    # users followed by other guilds already have a subscription
+    subscribed = {
+        sub.user_id for sub in await aiodb.run(
+            opers.list_subinfo_by_user_ids, [user["id"] for user in found]) or []
+    }
+    accepted = [
+        {
+            "user_id": user["id"],
+            "user_name": user["login"].lower(),
+            "guild_id": message.channel.guild.id,
+            "sub_body": None,
+        }
+        for user in found if user["id"] in subscribed
+    ]
+
+    unsubscribed = [user for user in found if user["id"] not in subscribed]
+    sub_bodies = [get_sub_body(user["id"]) for user in unsubscribed]
+    # concurrent adds of a user from other guilds post the same secret
+    sub_secrets = await aiodb.run(opers.reserve_subinfo, {
+        user["id"]: sub_body for user, sub_body in zip(unsubscribed, sub_bodies)
+    }) if len(unsubscribed) > 0 else {}
+    if sub_secrets is None:
+        for user in unsubscribed:
+            results[user["login"].lower()] = "Add Error"
+
+        unsubscribed, sub_bodies = [], []
+
+    for user, sub_body in zip(unsubscribed, sub_bodies):
+        sub_body["hub.secret"] = sub_secrets.get(str(user["id"])) or sub_body["hub.secret"]
+
+    statuses = await post_hub(sub_bodies)
+    refused = list()
+    for user, sub_body, status in zip(unsubscribed, sub_bodies, statuses):
+        if status == 202:
+            accepted.append({
+                "user_id": user["id"],
+                "user_name": user["login"].lower(),
+                "guild_id": message.channel.guild.id,
+                "sub_body": sub_body,
+            })
+
+        else:
+            refused.append(user["id"])
+            results[user["login"].lower()] = "Add Error With Response: {}".format(status)
 
-            user_id = json_body["data"][0]["id"]
+    if len(accepted) > 0:
+        added = await aiodb.run(opers.add_users, accepted)
+        for user in accepted:
+            results[user["user_name"]] = "Added" if added else "Add Error"
 
-    sub_info = opers.remove_user(
-        user_id=str(user_id),
-        guild_id=message.guild.id,
-    )
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            HUB_URL,
-            data=json.dumps(sub_info.get_unsub_body()),
-            headers=setting.get_headers()
-        ) as resp:
-            if resp.status == 202:
-                await message.channel.send("Successfully Removed!")
-
-            else:
-                await message.channel.send(
-                    "Remove Error With Response: {}".format(resp.status))
-                return
+        if not added:
+            refused.extend(
+                user["user_id"] for user in accepted if user["sub_body"] is not None)
+
+    if len(refused) > 0:
+        await aiodb.run(opers.release_subinfo, refused)
 
-    return
+    await send_summary(message.channel, "Successfully Added {}/{} users.".format(
+        sum(1 for result in results.values() if result == "Added"),
+        len(logins)), logins, results)
+
+async def do_unsubscribe(message):
+    logins = parse_logins(message)
+    if len(logins) == 0:
+        await message.channel.send(
+            "Format: /remove <twitch_username> [<twitch_username> ...]")
+        return
+
+    users = await resolver.resolver.resolve(logins, priority=twitch.INTERACTIVE)
+    results = {
+        login: "No such user" for login in logins if login not in users}
+    found = [users[login] for login in logins if login in users]
+
+    removed = dict()
+    if len(found) > 0:
+        removed = await aiodb.run(
+            opers.remove_users,
+            [user["id"] for user in found],
+            message.guild.id,
+        )
+        if removed is None:
+            removed = dict()
+            for user in found:
+                results[user["login"].lower()] = "Remove Error"
+
+    unsubscribed = list()
+    for user in found:
+        login = user["login"].lower()
+        if login in results:
+            continue
+
+        if str(user["id"]) not in removed:
+            results[login] = "Not registered"
+
+        elif removed[str(user["id"])] is None:
+            # other guilds still follow the user
+            results[login] = "Removed"
+
+        else:
+            unsubscribed.append((login, removed[str(user["id"])]))
+
+    statuses = await post_hub(
+        [sub_info.get_unsub_body() for _, sub_info in unsubscribed])
+    for (login, _), status in zip(unsubscribed, statuses):
+        if status == 202:
+            results[login] = "Removed"
+
+        else:
+            results[login] = "Remove Error With Response: {}".format(status)
+
+    await send_summary(message.channel, "Successfully Removed {}/{} users.".format(
+        sum(1 for result in results.values() if result == "Removed"),
+        len(logins)), logins, results)
 
 async def get_user_list(message):
     guild_id = message.guild.id
-    users = opers.list_users(guild_id)
+    users = await aiodb.run(opers.list_users, guild_id)
 
     if users is None:
         await message.channel.send("Get user list error.")
@@ -204,7 +597,8 @@ async def get_user_list(message):
         await message.channel.send("\n".join(users_str))
 
 async def set_channel(message):
-    result = opers.register_channel(
+    result = await aiodb.run(
+        opers.register_channel,
         message.guild.id,
         message.channel.id,
     )
@@ -224,11 +618,13 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="0.0.0.0")
     args = parser.parse_args()
 
-    # Initialize DB
-    init_db()
-
     # load params
     setting.load_setting(args.setting)
 
+    # Initialize DB
+    db.configure_engine(setting)
+    init_db()
+    migrate_db()
+
     # run server
     api.run(address=args.host, port=args.port)
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import db
+from lib import aiodb
+
+N_WEBHOOKS = 20
+DB_LATENCY = 0.01 # seconds
+
+
+def db_operation(user_id, session=None):
+    # emulate a Postgres round-trip
+    time.sleep(DB_LATENCY)
+
+    return user_id
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+@pytest.fixture
+def sqlite_engine():
+    engine = create_engine(
+        "sqlite:///:memory:", echo=False, poolclass=StaticPool,
+        connect_args={"check_same_thread": False})
+    db.Session.remove()
+    db.Session.configure(bind=engine)
+    yield engine
+
+    db.Session.remove()
+    db.Session.configure(bind=db.engine)
+
+async def measure_lag(handler) -> float:
+    lags = list()
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    results = await asyncio.gather(*[handler(i) for i in range(N_WEBHOOKS)])
+    done.set()
+    await task
+
+    assert sorted(results) == list(range(N_WEBHOOKS))
+
+    return max(lags)
+
+def test_event_loop_lag(loop):
+    async def blocking(user_id):
+        await asyncio.sleep(0)
+        return db_operation(user_id, session=object())
+
+    async def threaded(user_id):
+        return await aiodb.run(db_operation, user_id, session=object())
+
+    blocking_lag = loop.run_until_complete(measure_lag(blocking))
+    threaded_lag = loop.run_until_complete(measure_lag(threaded))
+    aiodb.shutdown()
+
+    print("max event loop lag: blocking {:.4f}s, executor {:.4f}s".format(
+        blocking_lag, threaded_lag))
+
+    assert blocking_lag >= N_WEBHOOKS * DB_LATENCY * 0.9
+    assert threaded_lag < blocking_lag / 4
+
+def test_session_per_task(loop, sqlite_engine):
+    sessions = list()
+    checkouts = db.metrics.checkouts
+
+    def operation(session=None):
+        sessions.append(session)
+        time.sleep(DB_LATENCY)
+
+        return session.execute("SELECT 1").scalar()
+
+    async def run_all():
+        return await asyncio.gather(*[aiodb.run(operation) for _ in range(10)])
+
+    results = loop.run_until_complete(run_all())
+    aiodb.shutdown()
+
+    assert results == [1] * 10
+    assert len(set(id(session) for session in sessions)) == 10
+    assert db.metrics.checkouts == checkouts + 10
+    assert db.pool_stats()["checkouts"] == checkouts + 10
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import asyncio
+
+import pytest
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import auth
+from lib import twitch
+from lib.ratelimit import NOTIFY, TokenBucket
+from lib.setting import Setting
+
+
+setting = Setting.get_instance()
+setting.load_setting(os.path.join(src_dir, "../settings.json"))
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(auth.AppToken, "enabled", property(lambda self: True))
+
+class FakeResponse(object):
+    def __init__(self, status, body, delay=0.0):
+        self.status = status
+        self.body = body
+        self.headers = {}
+        self.delay = delay
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.delay)
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def json(self):
+        return self.body
+
+    async def text(self):
+        return json.dumps(self.body)
+
+class FakeSession(object):
+    def __init__(self, expires_in=5000000, valid=None, failing=False):
+        self.expires_in = expires_in
+        self.failing = failing
+        # tokens accepted by the API, all when None
+        self.valid = valid
+        self.tokens = []
+        self.authorizations = []
+
+    def post(self, url, params=None):
+        assert url == auth.TOKEN_URL
+        assert params["grant_type"] == "client_credentials"
+        if self.failing:
+            self.tokens.append(None)
+            return FakeResponse(400, {"status": 400, "message": "invalid client secret"})
+
+        self.tokens.append("token{}".format(len(self.tokens)))
+
+        return FakeResponse(200, {
+            "access_token": self.tokens[-1],
+            "expires_in": self.expires_in,
+            "token_type": "bearer",
+        }, delay=0.01)
+
+    def request(self, method, url, headers=None, **kwargs):
+        authorization = headers.get("Authorization", None)
+        self.authorizations.append(authorization)
+        if self.valid is not None and authorization not in self.valid:
+            return FakeResponse(401, {"status": 401, "message": "Invalid OAuth token"})
+
+        return FakeResponse(200, {"data": []})
+
+def test_single_flight(loop, enabled):
+    app_token = auth.AppToken()
+    session = FakeSession()
+
+    async def test_coro():
+        return await asyncio.gather(*[app_token.get(session) for _ in range(10)])
+
+    tokens = loop.run_until_complete(test_coro())
+    cached = loop.run_until_complete(app_token.get(session))
+
+    assert tokens == ["token0"] * 10
+    assert cached == "token0"
+    assert session.tokens == ["token0"]
+    assert app_token.stats()["fetched"] == 1
+
+def test_refresh_before_expiry(loop, enabled):
+    app_token = auth.AppToken(margin=0.1)
+    session = FakeSession(expires_in=0.3)
+
+    first = loop.run_until_complete(app_token.get(session))
+    loop.run_until_complete(asyncio.sleep(0.25))
+    second = loop.run_until_complete(app_token.get(session))
+
+    assert (first, second) == ("token0", "token1")
+    assert app_token.stats()["expires_in"] > 0.2
+
+def test_failure_backoff(loop, enabled):
+    app_token = auth.AppToken(backoff=0.2)
+    session = FakeSession(failing=True)
+
+    async def test_coro():
+        return await asyncio.gather(*[app_token.get(session) for _ in range(10)])
+
+    assert loop.run_until_complete(test_coro()) == [None] * 10
+    # later calls skip the token request until the backoff ends
+    assert loop.run_until_complete(app_token.get(session)) is None
+    assert session.tokens == [None]
+
+    loop.run_until_complete(asyncio.sleep(0.2))
+    session.failing = False
+    assert loop.run_until_complete(app_token.get(session)) == "token1"
+    assert app_token.stats()["failed"] == 1
+
+def test_disabled(loop):
+    app_token = auth.AppToken()
+    session = FakeSession()
+
+    assert loop.run_until_complete(app_token.get(session)) is None
+    assert session.tokens == []
+    assert "Authorization" not in setting.get_headers(None)
+
+def test_request_retries_unauthorized(loop, enabled, monkeypatch):
+    app_token = auth.AppToken()
+    session = FakeSession(valid={"Bearer token1"})
+    monkeypatch.setattr(auth, "app_token", app_token)
+    monkeypatch.setattr(twitch, "get_session", lambda: session)
+    monkeypatch.setattr(twitch, "_bucket", TokenBucket())
+
+    status, body = loop.run_until_complete(
+        twitch.request("GET", twitch.USERS_API, priority=NOTIFY))
+
+    assert status == 200
+    assert session.authorizations == ["Bearer token0", "Bearer token1"]
+    assert app_token.stats()["invalidated"] == 1
+
+    # the new token is shared by later requests
+    loop.run_until_complete(twitch.request("GET", twitch.USERS_API))
+    assert session.authorizations[-1] == "Bearer token1"
+    assert session.tokens == ["token0", "token1"]
@@ -0,0 +1,76 @@
+import os
+import sys
+import asyncio
+
+import pytest
+import discord
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib.dispatcher import FanoutDispatcher
+
+
+class RateLimitResponse(object):
+    status = 429
+    reason = "Too Many Requests"
+    headers = {"Retry-After": "0.05"}
+
+class Channel(object):
+    def __init__(self, channel_id, rate_limited=0):
+        self.id = channel_id
+        self.rate_limited = rate_limited
+        self.sent = []
+
+    async def send(self, content=None, embed=None):
+        if self.rate_limited > 0:
+            self.rate_limited -= 1
+            raise discord.HTTPException(RateLimitResponse(), "rate limited")
+
+        await asyncio.sleep(0.01)
+        self.sent.append(content)
+
+        return content
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+def test_dispatch(loop):
+    dispatcher = FanoutDispatcher(concurrency=10, max_retries=2)
+    channels = [Channel(i) for i in range(100)]
+    channels.append(Channel(100, rate_limited=1))
+    channels.append(Channel(101, rate_limited=5))
+
+    report = loop.run_until_complete(
+        dispatcher.dispatch(channels, "content"))
+
+    assert report["sent"] == 101
+    assert report["failed"] == 1
+    assert report["first"] <= report["p95"] <= report["last"]
+    # rate limited channel waits the advised delay before retry
+    assert report["last"] >= 0.05
+    assert channels[100].sent == ["content"]
+    assert channels[101].sent == []
+
+def test_dispatch_connection_error(loop):
+    dispatcher = FanoutDispatcher(concurrency=10)
+    channels = [Channel(i) for i in range(3)]
+
+    async def timeout(content=None, embed=None):
+        raise asyncio.TimeoutError()
+
+    async def reset(content=None, embed=None):
+        raise ConnectionResetError("Connection reset by peer")
+
+    channels[1].send = timeout
+    channels[2].send = reset
+
+    report = loop.run_until_complete(
+        dispatcher.dispatch(channels, "content"))
+
+    # one broken channel does not lose the messages sent to the others
+    assert report["sent"] == 1
+    assert report["failed"] == 2
+    assert report["messages"] == ["content"]
@@ -1,17 +1,23 @@
 import os
 import sys
+import copy
+import time
+import tracemalloc
+import datetime as dt
 import warnings
 import logging
 import asyncio
 
 import pytest
 import discord
+import dateutil.parser
 
 src_path = os.path.realpath(__file__)
 src_dir = os.path.dirname(src_path)
 sys.path.append(os.path.join(src_dir, "../"))
 
 from lib import embed
+from lib import twitch
 from lib.setting import Setting
 
 logger = logging.getLogger()
@@ -72,3 +78,185 @@ def test_get_embed(loop):
 
     assert failed == None
     assert isinstance(succeed, discord.Embed)
+
+def test_game_title_cache(loop, monkeypatch):
+    calls = []
+
+    async def fake_fetch(game_id):
+        calls.append(game_id)
+        await asyncio.sleep(0.01)
+        return None if game_id == "0" else "Game {}".format(game_id)
+
+    monkeypatch.setattr(embed, "_fetch_game_title", fake_fetch)
+    embed.game_cache.clear()
+
+    async def lookup():
+        return await asyncio.gather(
+            *[embed.get_game_title("1") for _ in range(10)],
+            embed.get_game_title("0"),
+        )
+
+    titles = loop.run_until_complete(lookup())
+    cached = loop.run_until_complete(embed.get_game_title("1"))
+
+    assert titles[:10] == ["Game 1"] * 10
+    assert titles[-1] == "Unknown"
+    assert cached == "Game 1"
+    assert calls == ["1", "0"]
+    assert embed.game_cache.stats()["hits"] == 1
+    assert embed.game_cache.stats()["coalesced"] == 9
+
+@pytest.mark.parametrize("n_guilds", [1, 50])
+def test_user_thumbnail_cache(loop, monkeypatch, n_guilds):
+    requests = []
+
+    async def fake_request(method, url, priority=twitch.BACKGROUND, **kwargs):
+        requests.append(url)
+        await asyncio.sleep(0.01)
+        return 200, {"data": [{"profile_image_url": "https://link/to/profile.png"}]}
+
+    monkeypatch.setattr(twitch, "request", fake_request)
+    embed.thumbnail_cache.clear()
+
+    async def lookup():
+        # every guild announcing the stream asks for the same thumbnail
+        return await asyncio.gather(*[
+            embed.get_user_thumbnail("Domahoki" if i % 2 else "domahoki")
+            for i in range(n_guilds)
+        ])
+
+    thumbnails = loop.run_until_complete(lookup())
+    cached = loop.run_until_complete(embed.get_user_thumbnail("domahoki"))
+
+    assert thumbnails == ["https://link/to/profile.png"] * n_guilds
+    assert cached == "https://link/to/profile.png"
+    assert requests == [embed.USER_API.format("domahoki")]
+
+def test_warm_user_thumbnails(loop, monkeypatch):
+    batches = []
+
+    async def fake_request(method, url, priority=twitch.BACKGROUND, params=None, **kwargs):
+        assert url == twitch.USERS_API
+        logins = [login for _, login in params]
+        batches.append(logins)
+        return 200, {"data": [
+            {"login": login, "profile_image_url": "https://link/to/{}.png".format(login)}
+            for login in logins
+        ]}
+
+    monkeypatch.setattr(twitch, "request", fake_request)
+    embed.thumbnail_cache.clear()
+    user_names = ["user{}".format(i) for i in range(250)]
+    for name in user_names[:10]:
+        embed.thumbnail_cache.set(name, "https://link/to/cached.png")
+
+    warmed = loop.run_until_complete(embed.warm_user_thumbnails(user_names))
+
+    assert warmed == 240
+    assert [len(batch) for batch in batches] == [100, 100, 40]
+    assert not set(user_names[:10]) & {login for batch in batches for login in batch}
+
+    # warmed thumbnails are served without more lookups
+    thumbnail = loop.run_until_complete(embed.get_user_thumbnail("User42"))
+    assert thumbnail == "https://link/to/user42.png"
+    assert loop.run_until_complete(
+        embed.get_user_thumbnail("user0")) == "https://link/to/cached.png"
+    assert len(batches) == 3
+
+LEGACY_TEMPLATE = {
+    "title": "",
+    "url": "",
+    "timestamp": "",
+    "image": {
+        "url": "",
+    },
+    "thumbnail": {
+        "url": "",
+    },
+    "author": {
+        "name": "",
+        "icon_url": "",
+    },
+    "fields": [
+        {
+            "name": "Game",
+            "value": ""
+        }
+    ]
+}
+
+def legacy_build_embed(user_name, stream_info, user_thumbnail, game_title):
+    # Embed construction as it was before build_embed: deepcopy of the
+    # template, dateutil and Embed.from_dict.
+    embed_dict = copy.deepcopy(LEGACY_TEMPLATE)
+    timestamp = dateutil.parser.parse(stream_info["started_at"])
+
+    embed_dict["title"] = stream_info["title"]
+    embed_dict["url"] = embed.TWTICH_URL_BASE.format(user_name)
+    embed_dict["timestamp"] = dt.datetime.isoformat(timestamp)
+    embed_dict["thumbnail"]["url"] = user_thumbnail
+    embed_dict["image"]["url"] = stream_info["thumbnail_url"]
+    embed_dict["author"]["name"] = user_name
+    embed_dict["author"]["icon_url"] = user_thumbnail
+    embed_dict["fields"][0]["value"] = game_title
+
+    return discord.Embed.from_dict(embed_dict)
+
+def rendered(embed_obj):
+    # "type" defaults to rich and a missing "inline" means False on Discord.
+    data = embed_obj.to_dict()
+    data.pop("type", None)
+    for field in data.get("fields", []):
+        field.setdefault("inline", False)
+
+    return data
+
+@pytest.mark.parametrize("iso_str", [
+    "2017-08-14T16:08:32Z",
+    "2020-02-29T23:59:59Z",
+    "2017-12-01T10:09:45",
+    "2017-08-14T16:08:32.123Z",
+    "2017-08-14T16:08:32+09:00",
+])
+def test_parse_iso(iso_str):
+    assert embed.parse_iso(iso_str) == dateutil.parser.parse(iso_str)
+
+def test_build_embed_benchmark():
+    stream_info = {
+        "id": "0123456789",
+        "user_id": "5678",
+        "user_name": "wjdtkdqhs",
+        "game_id": "21779",
+        "type": "live",
+        "title": "Best Stream Ever",
+        "viewer_count": 417,
+        "started_at": "2017-08-14T16:08:32Z",
+        "language": "en",
+        "thumbnail_url": "https://link/to/thumbnail.jpg",
+    }
+    args = ("testman", stream_info, "https://link/to/icon.png", "Game")
+    rounds = 2000
+
+    assert rendered(embed.build_embed(*args)) == rendered(legacy_build_embed(*args))
+
+    def measure(build):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            build(*args)
+        elapsed = (time.perf_counter() - start) / rounds
+
+        tracemalloc.start()
+        build(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return elapsed, peak
+
+    legacy_time, legacy_peak = measure(legacy_build_embed)
+    new_time, new_peak = measure(embed.build_embed)
+
+    print("per embed: legacy {:.1f}us peak {}B, build_embed {:.1f}us peak {}B".format(
+        legacy_time * 1e6, legacy_peak, new_time * 1e6, new_peak))
+
+    assert new_time < legacy_time
+    assert new_peak < legacy_peak
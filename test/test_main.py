@@ -1,18 +1,31 @@
 import os
 import sys
+import json
 import asyncio
 
 import pytest
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
 
 src_path = os.path.realpath(__file__)
 src_dir = os.path.dirname(src_path)
 sys.path.append(os.path.join(src_dir, "../"))
 
+import main
 from main import handle_webhooks, client
 from lib import db
+from lib import aiodb
+from lib import embed
 from lib import operations as opers
+from lib import worker
+from lib import streamstate
+from lib import routing
+from lib import signature
+from lib import announcements
+from lib import twitch
+from lib import ratelimit
+from lib import resolver
 from lib.setting import Setting
 
 
@@ -23,7 +36,14 @@ class Request(object):
     method = None
 
     def __init__(self):
-        pass
+        self.headers = {}
+
+    @property
+    def content(self):
+        return self.body()
+
+    async def body(self):
+        return json.dumps(await self.media()).encode("utf-8")
 
     async def media(self):
         return {
@@ -44,14 +64,39 @@ class Request(object):
 
 class Response(object):
     text = ""
+    status_code = 200
 
     def __init__(self):
         pass
 
+class Channel(object):
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = []
+        self.messages = []
+
+    async def send(self, content=None, embed=None):
+        self.sent.append((content, embed))
+        self.messages.append(Message(self, content, embed))
+
+        return self.messages[-1]
+
+class Message(object):
+    def __init__(self, channel, content, embed):
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.edits = []
+
+    async def edit(self, content=None, embed=None):
+        self.edits.append((content, embed))
+
 @pytest.fixture
 def test_db():
     # OnMemory DB for test
-    engine = create_engine("sqlite:///:memory:", echo=False)
+    engine = create_engine(
+        "sqlite:///:memory:", echo=False, poolclass=StaticPool,
+        connect_args={"check_same_thread": False})
     Session = scoped_session(sessionmaker(bind=engine))
     db.Base.metadata.create_all(engine)
 
@@ -103,3 +148,553 @@ def test_handle_webhooks(loop, test_db):
     client.run(setting["discord_token"])
 
     assert future.result() is None
+
+@pytest.mark.parametrize("n_guilds", [1, 10, 50])
+def test_handle_webhooks_helix_calls(loop, test_db, monkeypatch, n_guilds):
+    req = Request()
+    req.method = "post"
+    resp = Response()
+    user_id = "72151546"
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+    helix_calls = []
+
+    async def fetch_game_title(game_id):
+        helix_calls.append(game_id)
+        return "Game"
+
+    async def fetch_user_thumbnail(user_name):
+        helix_calls.append(user_name)
+        return "https://link/to/profile.png"
+
+    channels = {}
+    monkeypatch.setattr(streamstate, "states", streamstate.StreamStateStore())
+    monkeypatch.setattr(embed, "_fetch_game_title", fetch_game_title)
+    monkeypatch.setattr(embed, "_fetch_user_thumbnail", fetch_user_thumbnail)
+    monkeypatch.setattr(
+        client, "get_channel",
+        lambda channel_id: channels.setdefault(channel_id, Channel(channel_id)))
+    embed.game_cache.clear()
+    embed.thumbnail_cache.clear()
+
+    for i in range(n_guilds):
+        opers.register_channel(
+            guild_id=str(1000 + i), channel_id=str(2000 + i), session=test_db)
+        opers.add_user(
+            user_id=user_id, user_name="domahoki", guild_id=str(1000 + i),
+            sub_body=sub_body, session=test_db)
+
+    loop.run_until_complete(handle_webhooks(
+        req, resp, user_id=user_id, session=test_db))
+    # retried delivery
+    loop.run_until_complete(handle_webhooks(
+        req, resp, user_id=user_id, session=test_db))
+
+    assert len(helix_calls) == 2
+    assert len(channels) == n_guilds
+    for channel in channels.values():
+        assert len(channel.sent) == 1
+
+    resp = Response()
+    loop.run_until_complete(main.handle_metrics(Request(), resp))
+    lines = resp.text.splitlines()
+    for sample in (
+        'webhook_seconds_count{path="inline"}',
+        'webhook_events_total{event="online"}',
+        'webhook_events_total{event="duplicate"}',
+        'db_operation_seconds_count{operation="get_delivery_targets"}',
+        'discord_request_seconds_count{method="send"}',
+        'cache_requests_total{cache="game",result="miss"}',
+        'helix_rate_limit_wait_seconds{priority="notify",stat="max"}',
+    ):
+        assert any(line.startswith(sample + " ") for line in lines)
+
+def test_handle_webhooks_queued(loop, monkeypatch):
+    processed = []
+
+    async def process_webhook(user_id, data):
+        await asyncio.sleep(0.01)
+        processed.append(user_id)
+
+    queue = worker.WebhookQueue(process_webhook, maxsize=1, workers=1)
+    table = routing.RoutingTable()
+    table.load([], [])
+    table.set_secret("72151546", 1, None)
+    monkeypatch.setattr(main, "webhook_queue", queue)
+    monkeypatch.setattr(routing, "table", table)
+
+    async def test_coro():
+        queue.start()
+        responses = list()
+        for _ in range(2):
+            req = Request()
+            req.method = "post"
+            resp = Response()
+            await handle_webhooks(req, resp, user_id="72151546")
+            responses.append(resp)
+
+        depth = queue.stats()["depth"]
+        await queue.drain()
+
+        return responses, depth
+
+    responses, depth = loop.run_until_complete(test_coro())
+
+    assert depth == 1
+    assert [resp.status_code for resp in responses] == [200, 503]
+    assert processed == ["72151546"]
+    assert queue.stats()["processed"] == 1
+    assert queue.stats()["rejected"] == 1
+    assert not queue.running
+
+def test_handle_webhooks_signature(loop, test_db, monkeypatch):
+    user_id = "72151546"
+    secret = "s3cr3t"
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe",
+        "hub.secret": secret,
+    }
+    opers.add_user(
+        user_id=user_id, user_name="domahoki", guild_id="1000",
+        sub_body=sub_body, session=test_db)
+    processed = []
+
+    async def process_webhook(user_id, data, session=None):
+        processed.append(user_id)
+
+    monkeypatch.setattr(main, "process_webhook", process_webhook)
+    rejected = signature.stats["rejected"]
+
+    def post(headers):
+        req = Request()
+        req.method = "post"
+        req.headers = headers
+        resp = Response()
+        loop.run_until_complete(handle_webhooks(
+            req, resp, user_id=user_id, session=test_db))
+
+        return resp.status_code
+
+    body = loop.run_until_complete(Request().body())
+    statuses = [
+        post({}),
+        post({signature.HEADER: signature.sign(body, "wrong")}),
+        post({signature.HEADER: "sha1=0123"}),
+        post({signature.HEADER: signature.sign(body, secret)}),
+    ]
+
+    assert statuses == [403, 403, 403, 200]
+    assert processed == [user_id]
+    assert signature.stats["rejected"] == rejected + 3
+
+def test_handle_webhooks_edit_in_place(loop, test_db, monkeypatch):
+    user_id = "72151546"
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+    game_calls = []
+
+    async def fetch_game_title(game_id):
+        game_calls.append(game_id)
+        return "Game {}".format(game_id)
+
+    async def fetch_user_thumbnail(user_name):
+        return "https://link/to/profile.png"
+
+    channels = {}
+    monkeypatch.setattr(streamstate, "states", streamstate.StreamStateStore())
+    monkeypatch.setattr(announcements, "store", announcements.AnnouncementStore())
+    monkeypatch.setattr(embed, "_fetch_game_title", fetch_game_title)
+    monkeypatch.setattr(embed, "_fetch_user_thumbnail", fetch_user_thumbnail)
+    monkeypatch.setattr(
+        client, "get_channel",
+        lambda channel_id: channels.setdefault(channel_id, Channel(channel_id)))
+    embed.game_cache.clear()
+    embed.thumbnail_cache.clear()
+
+    for i in range(3):
+        opers.register_channel(
+            guild_id=str(1000 + i), channel_id=str(2000 + i), session=test_db)
+        opers.add_user(
+            user_id=user_id, user_name="domahoki", guild_id=str(1000 + i),
+            sub_body=sub_body, session=test_db)
+
+    online = loop.run_until_complete(Request().media())
+    title_changed = json.loads(json.dumps(online))
+    title_changed["data"][0]["title"] = "New Title"
+    game_changed = json.loads(json.dumps(title_changed))
+    game_changed["data"][0]["game_id"] = "32399"
+
+    for data in (online, title_changed, title_changed, game_changed, {"data": []}):
+        loop.run_until_complete(main.process_webhook(
+            user_id, data, session=test_db))
+
+    assert game_calls == ["21779", "32399"]
+    assert len(announcements.store) == 0
+    assert len(channels) == 3
+    for channel in channels.values():
+        assert len(channel.sent) == 1
+
+        message = channel.messages[0]
+        assert len(message.edits) == 3
+        assert message.edits[0][0] == message.content
+        assert message.edits[0][1].title == "New Title"
+        assert message.edits[1][1].fields[0].value == "Game 32399"
+        assert message.edits[2][0].startswith("domahokiさんの配信が終わったよ.")
+
+def test_process_webhook_serialized(loop, test_db, monkeypatch):
+    user_id = "72151546"
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+
+    async def fetch_game_title(game_id):
+        # the go-live is still being built when the offline event arrives
+        await asyncio.sleep(0.05)
+        return "Game"
+
+    async def fetch_user_thumbnail(user_name):
+        return "https://link/to/profile.png"
+
+    channels = {}
+    monkeypatch.setattr(streamstate, "states", streamstate.StreamStateStore())
+    monkeypatch.setattr(announcements, "store", announcements.AnnouncementStore())
+    monkeypatch.setattr(main, "webhook_locks", worker.KeyedLock())
+    monkeypatch.setattr(embed, "_fetch_game_title", fetch_game_title)
+    monkeypatch.setattr(embed, "_fetch_user_thumbnail", fetch_user_thumbnail)
+    monkeypatch.setattr(
+        client, "get_channel",
+        lambda channel_id: channels.setdefault(channel_id, Channel(channel_id)))
+    embed.game_cache.clear()
+    embed.thumbnail_cache.clear()
+
+    opers.register_channel(guild_id="1000", channel_id="2000", session=test_db)
+    opers.add_user(
+        user_id=user_id, user_name="domahoki", guild_id="1000",
+        sub_body=sub_body, session=test_db)
+
+    online = loop.run_until_complete(Request().media())
+
+    async def test_coro():
+        await asyncio.gather(
+            main.process_webhook(user_id, online, session=test_db),
+            main.process_webhook(user_id, {"data": []}, session=test_db),
+        )
+
+    loop.run_until_complete(test_coro())
+
+    # the offline event edits the go-live instead of racing it
+    message, = channels[2000].messages
+    assert len(channels[2000].sent) == 1
+    assert message.edits[0][0].startswith("domahokiさんの配信が終わったよ.")
+    assert len(announcements.store) == 0
+    assert len(main.webhook_locks) == 0
+
+    # an update without announcement is sent as a go-live
+    streamstate.states.record(user_id, online)
+    title_changed = json.loads(json.dumps(online))
+    title_changed["data"][0]["title"] = "New Title"
+    loop.run_until_complete(main.process_webhook(
+        user_id, title_changed, session=test_db))
+
+    assert len(channels[2000].sent) == 2
+    assert channels[2000].sent[-1][1].title == "New Title"
+    assert announcements.store.get(user_id).title == "New Title"
+
+def test_process_webhook_failed_go_live(loop, test_db, monkeypatch):
+    user_id = "72151546"
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+    calls = []
+
+    async def flaky_get_message(user_name, data):
+        calls.append(user_name)
+        if len(calls) == 1:
+            raise RuntimeError("Helix is down")
+
+        return "content", None
+
+    channels = {}
+    monkeypatch.setattr(streamstate, "states", streamstate.StreamStateStore())
+    monkeypatch.setattr(announcements, "store", announcements.AnnouncementStore())
+    monkeypatch.setattr(embed, "get_message", flaky_get_message)
+    monkeypatch.setattr(
+        client, "get_channel",
+        lambda channel_id: channels.setdefault(channel_id, Channel(channel_id)))
+
+    opers.register_channel(guild_id="1000", channel_id="2000", session=test_db)
+    opers.add_user(
+        user_id=user_id, user_name="domahoki", guild_id="1000",
+        sub_body=sub_body, session=test_db)
+
+    online = loop.run_until_complete(Request().media())
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(main.process_webhook(
+            user_id, online, session=test_db))
+
+    # the next delivery of the stream is still a go-live
+    loop.run_until_complete(main.process_webhook(
+        user_id, online, session=test_db))
+    loop.run_until_complete(main.process_webhook(
+        user_id, online, session=test_db))
+
+    assert len(calls) == 2
+    assert channels[2000].sent == [("content", None)]
+
+class FakeResponse(object):
+    def __init__(self, status, body=None):
+        self.status = status
+        self.body = body
+        self.headers = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def text(self):
+        return "" if self.body is None else json.dumps(self.body)
+
+class FakeTwitchSession(object):
+    def __init__(self, unknown, failing):
+        self.unknown = unknown
+        self.failing = failing
+        self.gets = []
+        self.posts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def request(self, method, url, **kwargs):
+        return getattr(self, method.lower())(url, **kwargs)
+
+    def get(self, url, params=None, headers=None):
+        logins = [login for _, login in params]
+        self.gets.append(logins)
+
+        return FakeResponse(200, {"data": [
+            {
+                "id": str(10000 + int(login[len("user"):])),
+                "login": login,
+                "profile_image_url": "https://link/to/{}.png".format(login),
+            }
+            for login in logins if login not in self.unknown
+        ]})
+
+    def post(self, url, data=None, headers=None):
+        sub_body = json.loads(data)
+        session = self
+
+        class Post(FakeResponse):
+            async def __aenter__(self):
+                session.in_flight += 1
+                session.max_in_flight = max(session.max_in_flight, session.in_flight)
+                await asyncio.sleep(0.001)
+                session.in_flight -= 1
+                session.posts.append(sub_body)
+
+                return self
+
+        failed = any(sub_body["hub.topic"].endswith(user_id) for user_id in self.failing)
+
+        return Post(500 if failed else 202)
+
+class Guild(object):
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class DiscordMessage(object):
+    def __init__(self, content, channel):
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+
+@pytest.mark.parametrize("n_users", [1, 150])
+def test_bulk_add_remove(loop, monkeypatch, n_users):
+    engine = create_engine(
+        "sqlite:///:memory:", echo=False, poolclass=StaticPool,
+        connect_args={"check_same_thread": False})
+    db.Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, "Session", scoped_session(sessionmaker(bind=engine)))
+
+    logins = ["user{}".format(i) for i in range(n_users)]
+    unknown = {logins[-1]} if n_users > 1 else set()
+    failing = {"10000"} if n_users > 1 else set()
+    fake = FakeTwitchSession(unknown, failing)
+    monkeypatch.setattr(twitch, "get_session", lambda: fake)
+    monkeypatch.setattr(twitch, "_bucket", ratelimit.TokenBucket(capacity=1000))
+    monkeypatch.setattr(main, "setting", setting)
+    monkeypatch.setattr(resolver, "resolver", resolver.LoginResolver())
+    table = routing.RoutingTable()
+    table.load([], [])
+    monkeypatch.setattr(routing, "table", table)
+
+    channel = Channel(1)
+    channel.guild = Guild("1000")
+
+    # duplicated and mixed case logins are resolved once
+    content = "/add " + " ".join(logins) + " " + logins[0].upper()
+    loop.run_until_complete(main.do_subscribe(DiscordMessage(content, channel)))
+
+    added = opers.list_users("1000", session=db.Session())
+    expected = n_users - len(unknown) - len(failing)
+    concurrency = int(setting.get(
+        "subscribe_concurrency", main.DEFAULT_SUBSCRIBE_CONCURRENCY))
+
+    assert len(fake.gets) == -(-n_users // twitch.USERS_PER_REQUEST)
+    assert len(fake.posts) == n_users - len(unknown)
+    assert fake.max_in_flight <= concurrency
+    assert len(added) == expected
+    assert len(channel.sent) == 1
+    assert channel.sent[0][0].startswith(
+        "Successfully Added {}/{} users.".format(expected, n_users))
+    for login in unknown:
+        assert "[No such user] {}".format(login) in channel.sent[0][0]
+
+    # another guild shares the subscriptions
+    fake.posts.clear()
+    other = Channel(2)
+    other.guild = Guild("2000")
+    content = "/add " + " ".join(logins)
+    loop.run_until_complete(main.do_subscribe(DiscordMessage(content, other)))
+
+    assert len(opers.list_users("2000", session=db.Session())) == expected
+    assert len(fake.posts) == len(failing)
+    assert len(opers.list_subinfo(session=db.Session())) == expected
+
+    # logins are known locally by now
+    assert len(fake.gets) == -(-n_users // twitch.USERS_PER_REQUEST)
+    assert resolver.resolver.stats()["local"] == expected
+
+    # unsubscribe only when the last guild leaves
+    fake.posts.clear()
+    content = "/remove " + " ".join(logins)
+    loop.run_until_complete(main.do_unsubscribe(DiscordMessage(content, channel)))
+
+    assert opers.list_users("1000", session=db.Session()) == []
+    assert fake.posts == []
+    assert len(channel.sent) == 2
+    assert channel.sent[1][0].startswith(
+        "Successfully Removed {}/{} users.".format(expected, n_users))
+
+    loop.run_until_complete(main.do_unsubscribe(DiscordMessage(content, other)))
+
+    assert opers.list_users("2000", session=db.Session()) == []
+    assert opers.list_subinfo(session=db.Session()) == []
+    assert len(fake.gets) == -(-n_users // twitch.USERS_PER_REQUEST)
+    assert len(fake.posts) == expected
+    assert all(post["hub.mode"] == "unsubscribe" for post in fake.posts)
+
+def test_concurrent_add_shares_secret(loop, monkeypatch):
+    engine = create_engine(
+        "sqlite:///:memory:", echo=False, poolclass=StaticPool,
+        connect_args={"check_same_thread": False})
+    db.Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, "Session", scoped_session(sessionmaker(bind=engine)))
+
+    fake = FakeTwitchSession(set(), set())
+    monkeypatch.setattr(twitch, "get_session", lambda: fake)
+    monkeypatch.setattr(twitch, "_bucket", ratelimit.TokenBucket(capacity=1000))
+    monkeypatch.setattr(main, "setting", setting)
+    monkeypatch.setattr(resolver, "resolver", resolver.LoginResolver())
+    table = routing.RoutingTable()
+    table.load([], [])
+    monkeypatch.setattr(routing, "table", table)
+
+    channels = [Channel(1), Channel(2)]
+    channels[0].guild = Guild("1000")
+    channels[1].guild = Guild("2000")
+
+    async def test_coro():
+        await asyncio.gather(*[
+            main.do_subscribe(DiscordMessage("/add user0", channel))
+            for channel in channels
+        ])
+
+    loop.run_until_complete(test_coro())
+
+    sub_info, = opers.list_subinfo(session=db.Session())
+    # whichever hub request is processed last, the stored secret is posted
+    assert {post["hub.secret"] for post in fake.posts} == {sub_info.secret}
+    assert table.get_secrets("10000") == [sub_info.secret]
+    for guild_id in ("1000", "2000"):
+        assert len(opers.list_users(guild_id, session=db.Session())) == 1
+
+def test_stop_cancels_background_tasks():
+    started = asyncio.Event()
+
+    async def forever():
+        started.set()
+        await asyncio.sleep(3600)
+
+    async def test_coro():
+        task = main.start_background(forever())
+        await started.wait()
+        assert task in main.background_tasks
+
+        await main.stop_discord_bot()
+
+        return task
+
+    task = asyncio.get_event_loop().run_until_complete(test_coro())
+
+    assert task.cancelled()
+    assert task not in main.background_tasks
+
+def test_process_webhook_without_session(loop, monkeypatch):
+    # the DB fallback opens its own session when the table is not loaded
+    engine = create_engine(
+        "sqlite:///:memory:", echo=False, poolclass=StaticPool,
+        connect_args={"check_same_thread": False})
+    db.Base.metadata.create_all(engine)
+    monkeypatch.setattr(db, "Session", scoped_session(sessionmaker(bind=engine)))
+    user_id = "98765432"
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+
+    async def fetch_game_title(game_id):
+        return "Game"
+
+    async def fetch_user_thumbnail(user_name):
+        return "https://link/to/profile.png"
+
+    channels = {}
+    monkeypatch.setattr(routing, "table", routing.RoutingTable())
+    monkeypatch.setattr(embed, "_fetch_game_title", fetch_game_title)
+    monkeypatch.setattr(embed, "_fetch_user_thumbnail", fetch_user_thumbnail)
+    monkeypatch.setattr(
+        client, "get_channel",
+        lambda channel_id: channels.setdefault(channel_id, Channel(channel_id)))
+
+    opers.register_channel(guild_id="1000", channel_id="2000", session=db.Session())
+    opers.add_user(
+        user_id=user_id, user_name="domahoki", guild_id="1000",
+        sub_body=sub_body, session=db.Session())
+
+    data = loop.run_until_complete(Request().media())
+    loop.run_until_complete(main.process_webhook(user_id, data))
+    aiodb.shutdown()
+
+    assert list(channels) == [2000]
+    assert len(channels[2000].sent) == 1
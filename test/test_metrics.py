@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+
+import pytest
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # metrics of a test are not rendered with the application ones
+    registry = []
+    monkeypatch.setattr(metrics, "_registry", registry)
+
+    return registry
+
+def test_histogram(registry):
+    histogram = metrics.Histogram(
+        "test_seconds", "Test.", ["path"], buckets=(0.1, 1.0))
+    child = histogram.labels("a")
+    for value in (0.05, 0.1, 0.5, 2.0):
+        child.observe(value)
+
+    with histogram.labels('b"c').time():
+        pass
+
+    lines = metrics.render().splitlines()
+
+    assert lines[:2] == ["# HELP test_seconds Test.", "# TYPE test_seconds histogram"]
+    assert 'test_seconds_bucket{path="a",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{path="a",le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{path="a",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{path="a"} 2.65' in lines
+    assert 'test_seconds_count{path="a"} 4' in lines
+    assert 'test_seconds_count{path="b\\"c"} 1' in lines
+
+def test_counter_and_collector(registry):
+    counter = metrics.Counter("test_total", "Test.", ["result"])
+    counter.labels("ok").inc()
+    counter.labels("ok").inc(2)
+    metrics.Collector("test_gauge", "Test.", "gauge", lambda: {(): 5})
+    metrics.Collector("test_broken", "Test.", "gauge", lambda: 1 / 0)
+
+    text = metrics.render()
+
+    assert 'test_total{result="ok"} 3' in text
+    assert "# TYPE test_gauge gauge\ntest_gauge 5" in text
+    assert "# TYPE test_broken gauge\n" in text
+
+def test_overhead(registry):
+    histogram = metrics.Histogram("test_seconds", "Test.", ["operation"])
+    counter = metrics.Counter("test_total", "Test.", ["operation"])
+    rounds = 100000
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        with histogram.labels("add_user").time():
+            pass
+        counter.labels("add_user").inc()
+    per_event = (time.perf_counter() - start) / rounds
+
+    print("recording cost per event: {:.2f}us".format(per_event * 1e6))
+
+    assert histogram.labels("add_user").counts[-1] + sum(
+        histogram.labels("add_user").counts[:-1]) == rounds
+    assert per_event < 20e-6
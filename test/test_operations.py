@@ -1,11 +1,12 @@
 import os
 import sys
+import time
 import datetime as dt
 import logging
 
 import pytest
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 src_path = os.path.realpath(__file__)
@@ -13,12 +14,14 @@ src_dir = os.path.dirname(src_path)
 sys.path.append(os.path.join(src_dir, "../"))
 
 from lib import db
+from lib import routing
 from lib.operations import (
     add_user, remove_user, list_users, get_users,
-    list_subinfo, update_subinfo, register_channel,
+    list_subinfo, list_expiring_subinfo, renew_subinfo, register_channel,
     list_channels, get_channel, get_channel_by_user,
+    get_delivery_targets,
 )
-from lib.models import Users, Channels, SubInfo
+from lib.models import Users, Channels, SubInfo, migrate_db
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -43,6 +46,22 @@ def test_db():
 
     return session
 
+@pytest.fixture
+def sqlite_db():
+    # OnMemory DB counting executed statements
+    engine = create_engine("sqlite:///:memory:", echo=False)
+    Session = scoped_session(sessionmaker(bind=engine))
+    db.Base.metadata.create_all(engine)
+
+    session = Session()
+    session.statements = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        session.statements.append(statement)
+
+    return session
+
 def is_matched_user(
     user: Users,
     info: dict,
@@ -135,13 +154,13 @@ def test_01_add_user(test_db):
         if user.user_id == "10000":
             is_matched_user(user, user1)
 
-            sub_info = test_db.query(SubInfo).filter(SubInfo.id == user.id).first()
+            sub_info = test_db.query(SubInfo).filter(SubInfo.user_id == user.user_id).first()
             is_matched_subinfo(sub_info, sub_body, now1)
 
         elif user.user_id == "10001":
             is_matched_user(user, user3)
 
-            sub_info = test_db.query(SubInfo).filter(SubInfo.id == user.id).first()
+            sub_info = test_db.query(SubInfo).filter(SubInfo.user_id == user.user_id).first()
             is_matched_subinfo(sub_info, sub_body2, now2)
 
         else:
@@ -150,7 +169,7 @@ def test_01_add_user(test_db):
     for user in user_list2:
         is_matched_user(user, user4)
 
-        sub_info = test_db.query(SubInfo).filter(SubInfo.id == user.id).first()
+        sub_info = test_db.query(SubInfo).filter(SubInfo.user_id == user.user_id).first()
         is_matched_subinfo(sub_info, sub_body, now2)
 
 def test_remove_user(test_db):
@@ -209,13 +228,13 @@ def test_remove_user(test_db):
         if user.user_id == "10001":
             is_matched_user(user, user2)
 
-            sub_info = test_db.query(SubInfo).filter(SubInfo.id == user.id).first()
+            sub_info = test_db.query(SubInfo).filter(SubInfo.user_id == user.user_id).first()
             is_matched_subinfo(sub_info, sub_body2)
 
         elif user.user_id == "10000":
             is_matched_user(user, user3)
 
-            sub_info = test_db.query(SubInfo).filter(SubInfo.id == user.id).first()
+            sub_info = test_db.query(SubInfo).filter(SubInfo.user_id == user.user_id).first()
             is_matched_subinfo(sub_info, sub_body2)
 
         else:
@@ -272,3 +291,294 @@ def test_xx_register_channel(test_db):
 
     register_channel(12345, 12341)
     print(list_channels(session=test_db)[0])
+
+@pytest.mark.parametrize("n_guilds", [1, 100, 1000])
+def test_get_delivery_targets_benchmark(sqlite_db, n_guilds):
+    for i in range(n_guilds):
+        sqlite_db.add(Users(
+            user_id="10000", user_name="testman", guild_id=str(i)))
+        sqlite_db.add(Channels(guild_id=str(i), channel_id=str(i)))
+
+    # guild without channel is not a target
+    sqlite_db.add(Users(
+        user_id="10000", user_name="testman", guild_id="nochannel"))
+    sqlite_db.commit()
+
+    # per-guild lookups
+    del sqlite_db.statements[:]
+    start = time.perf_counter()
+    channel_ids = list()
+    for user in get_users("10000", session=sqlite_db):
+        channel = get_channel(user.guild_id, session=sqlite_db)
+        if channel is not None:
+            channel_ids.append(channel.channel_id)
+
+    per_guild_time = time.perf_counter() - start
+    per_guild_queries = len(sqlite_db.statements)
+
+    # joined lookup
+    del sqlite_db.statements[:]
+    start = time.perf_counter()
+    targets = get_delivery_targets("10000", session=sqlite_db)
+    joined_time = time.perf_counter() - start
+    joined_queries = len(sqlite_db.statements)
+
+    print("guilds={}: per-guild {} queries {:.4f}s, joined {} queries {:.4f}s".format(
+        n_guilds, per_guild_queries, per_guild_time, joined_queries, joined_time))
+
+    assert sorted(channel_id for _, channel_id in targets) == sorted(channel_ids)
+    assert len(targets) == n_guilds
+    assert per_guild_queries == 1 + (n_guilds + 1)
+    assert joined_queries == 1
+
+def test_routing_table_write_through(sqlite_db, monkeypatch):
+    table = routing.RoutingTable()
+    monkeypatch.setattr(routing, "table", table)
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+    register_channel("guild1", "channel1", session=sqlite_db)
+    add_user(10000, "testman", "guild1", sub_body=sub_body, session=sqlite_db)
+
+    # not loaded yet
+    assert table.get_targets("10000") is None
+
+    table.load(
+        list_users("guild1", session=sqlite_db),
+        list_channels(session=sqlite_db))
+    assert table.get_targets("10000") == [("testman", "channel1")]
+
+    add_user(10000, "testman", "guild2", sub_body=sub_body, session=sqlite_db)
+    assert table.get_targets("10000") == [("testman", "channel1")]
+
+    register_channel("guild2", "channel2", session=sqlite_db)
+    assert sorted(table.get_targets("10000")) == [
+        ("testman", "channel1"), ("testman", "channel2")]
+
+    register_channel("guild1", "channel3", session=sqlite_db)
+    remove_user(10000, "guild2", session=sqlite_db)
+    assert table.get_targets("10000") == [("testman", "channel3")]
+
+    remove_user(10000, "guild1", session=sqlite_db)
+    assert table.get_targets("10000") == []
+
+def test_shared_subscription(sqlite_db):
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe",
+        "hub.secret": "first",
+    }
+    add_user(10000, "testman", "guild1", sub_body=sub_body, session=sqlite_db)
+    add_user(10000, "testman", "guild2", sub_body=None, session=sqlite_db)
+    add_user(
+        10000, "testman", "guild3", sub_body=dict(sub_body, **{"hub.secret": "second"}),
+        session=sqlite_db)
+
+    sub_list = list_subinfo(session=sqlite_db)
+    assert sqlite_db.query(Users).count() == 3
+    assert len(sub_list) == 1
+    assert sub_list[0].secret == "second"
+
+    # unsubscribe with the last guild only
+    assert remove_user(10000, "guild1", session=sqlite_db) is None
+    assert remove_user(10000, "guild3", session=sqlite_db) is None
+    assert len(list_subinfo(session=sqlite_db)) == 1
+
+    sub_info = remove_user(10000, "guild2", session=sqlite_db)
+    assert sub_info.id == sub_list[0].id
+    assert sub_info.get_unsub_body()["hub.topic"] == sub_body["hub.topic"]
+    assert list_subinfo(session=sqlite_db) == []
+    assert sqlite_db.query(Users).count() == 0
+
+def test_query_count(sqlite_db):
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+
+    def queries(func, *args, **kwargs):
+        del sqlite_db.statements[:]
+        func(*args, **kwargs, session=sqlite_db)
+        for statement in sqlite_db.statements:
+            assert "count(" not in statement.lower()
+
+        return [
+            statement.split()[0].upper() for statement in sqlite_db.statements
+        ]
+
+    assert queries(register_channel, "guild1", "channel1") == ["SELECT", "INSERT"]
+    assert queries(register_channel, "guild1", "channel2") == ["SELECT", "UPDATE"]
+    assert queries(add_user, 10000, "testman", "guild1", sub_body=sub_body) == [
+        "SELECT", "INSERT", "SELECT", "INSERT"]
+    assert queries(add_user, 10000, "testman", "guild2", sub_body=None) == [
+        "SELECT", "INSERT"]
+    assert queries(get_users, 10000) == ["SELECT"]
+    assert queries(get_channel, "guild1") == ["SELECT"]
+    assert queries(get_channel_by_user, 10000, "guild1") == ["SELECT"]
+    assert queries(list_expiring_subinfo, dt.datetime.now()) == ["SELECT"]
+    sub_info = list_subinfo(session=sqlite_db)
+    assert queries(renew_subinfo, sub_info) == ["UPDATE"]
+    assert queries(remove_user, 10000, "guild2") == [
+        "SELECT", "DELETE", "SELECT"]
+    assert queries(remove_user, 10000, "guild1") == [
+        "SELECT", "DELETE", "SELECT", "SELECT", "DELETE"]
+
+def test_query_count_postgresql(test_db):
+    sub_body = {
+        "hub.callback": "http://callback/url/",
+        "hub.topic": "http://topic/url",
+        "hub.lease_seconds": 300,
+        "hub.mode": "subscribe"
+    }
+    statements = []
+
+    @event.listens_for(test_db.get_bind(), "before_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def queries(func, *args, **kwargs):
+        del statements[:]
+        func(*args, **kwargs, session=test_db)
+
+        return [" ".join(statement.upper().split()) for statement in statements]
+
+    # INSERT ... ON CONFLICT DO UPDATE, one statement per table
+    inserted = queries(add_user, 10000, "testman", "guild1", sub_body=sub_body)
+    assert [statement.split()[0] for statement in inserted] == ["INSERT", "INSERT"]
+    assert "ON CONFLICT (USER_ID, GUILD_ID) DO UPDATE" in inserted[0]
+    assert "ON CONFLICT (USER_ID) DO UPDATE" in inserted[1]
+    assert "RETURNING SUB_INFO.ID" in inserted[1]
+
+    inserted = queries(add_user, 10000, "testman", "guild2", sub_body=None)
+    assert [statement.split()[0] for statement in inserted] == ["INSERT"]
+
+    # DELETE ... RETURNING, the sub-info only with the last guild
+    for guild_id, removed in (("guild2", False), ("guild1", True)):
+        deleted = queries(remove_user, 10000, guild_id)
+        assert [statement.split()[0] for statement in deleted] == ["DELETE", "DELETE"]
+        assert all("RETURNING" in statement for statement in deleted)
+        assert (test_db.query(SubInfo).count() == 0) == removed
+
+def explain(session, statement):
+    compiled = statement.compile(
+        dialect=session.get_bind().dialect,
+        compile_kwargs={"literal_binds": True},
+    )
+    rows = session.execute("EXPLAIN QUERY PLAN {}".format(compiled)).fetchall()
+
+    return [row[-1] for row in rows]
+
+def test_index_usage(sqlite_db):
+    # SQLite schema check, see test_index_usage_postgresql for Postgres
+    # webhook routing
+    plan = explain(sqlite_db, sqlite_db.query(Users, Channels.channel_id).join(
+        Channels, Channels.guild_id == Users.guild_id
+    ).filter(Users.user_id == "10000").statement)
+    assert any("users USING INDEX uq_users_user_id_guild_id" in p for p in plan)
+    assert not any(p.startswith("SCAN") for p in plan)
+
+    # add_user, remove_user, get_channel_by_user
+    plan = explain(sqlite_db, sqlite_db.query(Users).filter(
+        Users.user_id == "10000", Users.guild_id == "guild").statement)
+    assert any("USING INDEX uq_users_user_id_guild_id" in p for p in plan)
+
+    # list_users
+    plan = explain(sqlite_db, sqlite_db.query(Users).filter(
+        Users.guild_id == "guild").statement)
+    assert any("USING INDEX ix_users_guild_id" in p for p in plan)
+
+    # subscription renewal
+    plan = explain(sqlite_db, sqlite_db.query(SubInfo).filter(
+        SubInfo.expires_at <= dt.datetime(2020, 1, 1)
+    ).order_by(SubInfo.expires_at).statement)
+    assert any("USING INDEX ix_sub_info_expires_at" in p for p in plan)
+
+    plan = explain(sqlite_db, SubInfo.__table__.update().where(
+        SubInfo.id == 1).values(date=dt.datetime(2020, 1, 1)))
+    assert not any(p.startswith("SCAN") for p in plan)
+
+    plan = explain(sqlite_db, sqlite_db.query(SubInfo).filter(
+        SubInfo.user_id == "10000").statement)
+    assert any("USING INDEX uq_sub_info_user_id" in p for p in plan)
+
+def explain_postgresql(session, statement):
+    compiled = statement.compile(dialect=session.get_bind().dialect)
+    # the planner prefers sequential scans of tiny test tables
+    session.execute("SET LOCAL enable_seqscan = off")
+    cursor = session.connection().connection.cursor()
+    cursor.execute("EXPLAIN {}".format(compiled), compiled.params)
+
+    return [row[0] for row in cursor.fetchall()]
+
+def test_index_usage_postgresql(test_db):
+    # webhook routing, add_user, remove_user, get_channel_by_user
+    plan = explain_postgresql(test_db, test_db.query(Users).filter(
+        Users.user_id == "10000", Users.guild_id == "guild").statement)
+    assert any("uq_users_user_id_guild_id" in p for p in plan)
+
+    # list_users
+    plan = explain_postgresql(test_db, test_db.query(Users).filter(
+        Users.guild_id == "guild").statement)
+    assert any("ix_users_guild_id" in p for p in plan)
+
+    # subscription renewal
+    plan = explain_postgresql(test_db, test_db.query(SubInfo).filter(
+        SubInfo.expires_at <= dt.datetime(2020, 1, 1)
+    ).order_by(SubInfo.expires_at).statement)
+    assert any("ix_sub_info_expires_at" in p for p in plan)
+
+    test_db.rollback()
+
+def test_migrate_db():
+    engine = create_engine("sqlite:///:memory:", echo=False)
+    legacy = [
+        "CREATE TABLE users (id INTEGER PRIMARY KEY, user_id VARCHAR, "
+        "user_name VARCHAR, update_date DATETIME, guild_id VARCHAR)",
+        "CREATE TABLE sub_info (id INTEGER PRIMARY KEY, user_id VARCHAR, "
+        "callback VARCHAR, topic VARCHAR, lease_seconds INTEGER, date DATETIME)",
+        "INSERT INTO users VALUES (1, '10000', 'old', '2020-01-01', 'guild')",
+        "INSERT INTO users VALUES (2, '10000', 'new', '2020-01-02', 'guild')",
+        "INSERT INTO users VALUES (3, '10001', 'other', '2020-01-02', 'guild')",
+        "INSERT INTO users VALUES (4, '10000', 'new', '2020-01-02', 'guild2')",
+        "INSERT INTO sub_info VALUES (1, '10000', 'c', 't', 300, '2020-01-01 00:00:00')",
+        "INSERT INTO sub_info VALUES (2, '10000', 'c', 't', 300, '2020-01-02 00:00:00')",
+        "INSERT INTO sub_info VALUES (3, '10001', 'c', 't', 300, '2020-01-02 00:00:00')",
+        "INSERT INTO sub_info VALUES (4, '10000', 'c', 't', 300, '2020-01-01 12:00:00')",
+        "INSERT INTO sub_info VALUES (5, '10002', 'c', 't', 300, '2020-01-01 12:00:00')",
+    ]
+    for statement in legacy:
+        engine.execute(statement)
+
+    migrate_db(engine)
+    # idempotent, keeping subscriptions reserved by an in-flight /add
+    engine.execute(
+        "INSERT INTO sub_info VALUES (6, '10003', 'c', 't', 300, "
+        "'2020-01-01 12:00:00', '2020-01-01 12:00:00', 'reserved')")
+    migrate_db(engine)
+    assert engine.execute("SELECT secret FROM sub_info WHERE id = 6").scalar() == "reserved"
+    engine.execute("DELETE FROM sub_info WHERE id = 6")
+
+    users = engine.execute("SELECT id, user_name FROM users ORDER BY id").fetchall()
+    sub_info = engine.execute("SELECT id FROM sub_info ORDER BY id").fetchall()
+    indexes = {
+        row[1] for row in engine.execute(
+            "SELECT type, name FROM sqlite_master WHERE type = 'index'")
+    }
+
+    assert [tuple(row) for row in users] == [(2, "new"), (3, "other"), (4, "new")]
+    assert [row[0] for row in sub_info] == [2, 3]
+    expires_at = engine.execute(
+        "SELECT expires_at FROM sub_info WHERE id = 2").scalar()
+    assert str(expires_at).startswith("2020-01-02 00:05:00")
+    assert {
+        "uq_users_user_id_guild_id", "ix_users_guild_id", "uq_sub_info_user_id",
+        "ix_sub_info_expires_at",
+    } <= indexes
+    assert "ix_sub_info_user_id" not in indexes
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import asyncio
+
+import pytest
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import twitch
+from lib.ratelimit import NOTIFY, INTERACTIVE, BACKGROUND, TokenBucket
+from lib.setting import Setting
+
+
+setting = Setting.get_instance()
+setting.load_setting(os.path.join(src_dir, "../settings.json"))
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+def test_priority_order(loop):
+    bucket = TokenBucket(capacity=2, window=0.2, reserve=0.0)
+    served = []
+
+    async def acquire(priority):
+        await bucket.acquire(priority)
+        served.append(priority)
+
+    async def test_coro():
+        # drain the bucket, the rest waits for refills
+        await bucket.acquire(NOTIFY)
+        await bucket.acquire(NOTIFY)
+        del served[:]
+        await asyncio.gather(
+            acquire(BACKGROUND),
+            acquire(BACKGROUND),
+            acquire(INTERACTIVE),
+            acquire(NOTIFY),
+        )
+
+    loop.run_until_complete(test_coro())
+    stats = bucket.stats()
+
+    assert served == [NOTIFY, INTERACTIVE, BACKGROUND, BACKGROUND]
+    assert stats["queued"] == 0
+    assert stats["background"]["count"] == 2
+    assert stats["background"]["max_wait"] >= stats["notify"]["max_wait"]
+
+def test_background_reserve(loop):
+    bucket = TokenBucket(capacity=10, window=1000, reserve=0.5)
+
+    async def test_coro():
+        for _ in range(5):
+            await asyncio.wait_for(bucket.acquire(BACKGROUND), 0.1)
+
+        # the reserve is left for notifications
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(bucket.acquire(BACKGROUND), 0.1)
+
+        for _ in range(5):
+            await asyncio.wait_for(bucket.acquire(NOTIFY), 0.1)
+
+    loop.run_until_complete(test_coro())
+
+def test_sync_headers(loop):
+    bucket = TokenBucket(capacity=30)
+    bucket.sync({
+        "Ratelimit-Limit": "800",
+        "Ratelimit-Remaining": "0",
+        "Ratelimit-Reset": str(time.time() + 0.2),
+    })
+
+    assert bucket.capacity == 800
+    assert bucket.tokens == 0
+
+    wait = loop.run_until_complete(bucket.acquire(NOTIFY))
+
+    # the bucket refills to 800 until reset
+    assert 0.0 < wait < 0.1
+    assert bucket.rate > 800
+
+    # headers without rate limit info are ignored
+    bucket.sync({})
+    assert bucket.capacity == 800
+
+class FakeResponse(object):
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def text(self):
+        return json.dumps(self.body)
+
+class FakeSession(object):
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        status = self.statuses.pop(0)
+        headers = {
+            "Ratelimit-Limit": "800",
+            "Ratelimit-Remaining": "0" if status == 429 else "799",
+            "Ratelimit-Reset": str(time.time() + 0.05),
+        }
+
+        return FakeResponse(status, headers, {"data": []})
+
+def test_request_retries_rate_limited(loop, monkeypatch):
+    session = FakeSession([429, 200])
+    monkeypatch.setattr(twitch, "get_session", lambda: session)
+    monkeypatch.setattr(twitch, "_bucket", TokenBucket())
+
+    status, body = loop.run_until_complete(
+        twitch.request("GET", twitch.USERS_API, priority=NOTIFY))
+
+    assert status == 200
+    assert body == {"data": []}
+    assert session.calls == 2
+    assert twitch.get_bucket().stats()["notify"]["count"] == 2
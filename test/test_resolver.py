@@ -0,0 +1,63 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import routing
+from lib import twitch
+from lib.models import Users
+from lib.resolver import LoginResolver
+from lib.setting import Setting
+
+
+setting = Setting.get_instance()
+setting.load_setting(os.path.join(src_dir, "../settings.json"))
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+def test_resolve(loop, monkeypatch):
+    table = routing.RoutingTable()
+    table.load([Users(user_id="10000", user_name="Registered", guild_id="1")], [])
+    monkeypatch.setattr(routing, "table", table)
+    calls = []
+
+    async def lookup_users(logins, priority=twitch.BACKGROUND):
+        calls.append(sorted(logins))
+        if "broken" in logins:
+            # failed request, neither found nor unknown
+            return {}, set()
+
+        return {"remote": {"id": "10001", "login": "remote"}}, {"unknown"}
+
+    monkeypatch.setattr(twitch, "lookup_users", lookup_users)
+    resolver = LoginResolver()
+    logins = ["registered", "REMOTE", "unknown"]
+
+    first = loop.run_until_complete(resolver.resolve(logins))
+    second = loop.run_until_complete(resolver.resolve(logins))
+    loop.run_until_complete(resolver.resolve(["broken"]))
+    loop.run_until_complete(resolver.resolve(["broken"]))
+
+    assert first == second == {
+        "registered": {"id": "10000", "login": "registered"},
+        "remote": {"id": "10001", "login": "remote"},
+    }
+    assert calls == [["remote", "unknown"], ["broken"], ["broken"]]
+    assert resolver.stats() == {
+        "local": 2,
+        "cached": 1,
+        "negative": 1,
+        "remote": 4,
+        "not_found": 1,
+    }
+
+    # removed from the index with the last guild
+    table.remove_user("10000", "1")
+    assert table.get_user_id("registered") is None
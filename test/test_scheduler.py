@@ -0,0 +1,186 @@
+import os
+import sys
+import asyncio
+import datetime as dt
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import db
+from lib import routing
+from lib import scheduler
+from lib.lease import LeaseScheduler
+from lib.models import SubInfo
+
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+@pytest.fixture
+def test_db():
+    engine = create_engine(
+        "sqlite:///:memory:", echo=False, poolclass=StaticPool,
+        connect_args={"check_same_thread": False})
+    db.Base.metadata.create_all(engine)
+    db.Session.remove()
+    db.Session.configure(bind=engine)
+    yield db.Session()
+
+    db.Session.remove()
+    db.Session.configure(bind=db.engine)
+
+def test_update_job(loop, test_db, monkeypatch):
+    now = dt.datetime.now()
+    for i in range(30):
+        # 20 expired, 10 valid
+        date = now - dt.timedelta(seconds=400) if i < 20 else now
+        test_db.add(SubInfo(
+            user_id=str(i), callback="http://callback/{}".format(i),
+            topic="http://topic/{}".format(i), lease_seconds=300, date=date))
+
+    test_db.commit()
+    running = {"now": 0, "max": 0}
+
+    async def update_sub(sub_info):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+
+        return sub_info.user_id != "0"
+
+    monkeypatch.setattr(scheduler, "update_sub", update_sub)
+    monkeypatch.setattr(scheduler, "DEFAULT_RENEW_CONCURRENCY", 5)
+
+    summary = loop.run_until_complete(scheduler.update_job())
+
+    assert summary == {"renewed": 19, "failed": 1, "skipped": 0}
+    assert running["max"] == 5
+
+    expired = [
+        sub.user_id for sub in test_db.query(SubInfo).filter(
+            SubInfo.expires_at <= dt.datetime.now())
+    ]
+    assert expired == ["0"]
+
+def test_lease_scheduler(loop):
+    renewed = list()
+    lease_scheduler = LeaseScheduler(margin=0.1, jitter=0, retry=10)
+
+    async def renew(sub_ids):
+        renewed.append((sorted(sub_ids), dt.datetime.now()))
+
+    async def test_coro():
+        lease_scheduler.start(renew)
+        start = dt.datetime.now()
+        lease_scheduler.schedule(1, start + dt.timedelta(seconds=0.2))
+        lease_scheduler.schedule(2, start + dt.timedelta(seconds=0.2))
+        lease_scheduler.schedule(3, start + dt.timedelta(seconds=0.3))
+        lease_scheduler.schedule(4, start + dt.timedelta(seconds=0.3))
+        lease_scheduler.cancel(4)
+        # reschedule to a later lease
+        lease_scheduler.schedule(2, start + dt.timedelta(seconds=10))
+        await asyncio.sleep(0.3)
+        await lease_scheduler.stop()
+
+        return start
+
+    start = loop.run_until_complete(test_coro())
+
+    assert [sub_ids for sub_ids, _ in renewed] == [[1], [3]]
+    assert renewed[0][1] - start >= dt.timedelta(seconds=0.1)
+    assert renewed[1][1] - start >= dt.timedelta(seconds=0.2)
+    assert renewed[1][1] - start < dt.timedelta(seconds=0.3)
+
+def test_lease_scheduler_load():
+    now = dt.datetime.now()
+    lease_scheduler = LeaseScheduler(margin=0, jitter=0)
+    reserved = SubInfo(
+        user_id="0", callback="http://callback/0", topic="http://topic/0",
+        lease_seconds=300, date=now)
+    reserved.id = 1
+    reserved.expires_at = now
+    legacy = SubInfo(
+        user_id="1", callback="http://callback/1", topic="http://topic/1",
+        lease_seconds=300, date=now - dt.timedelta(seconds=200))
+    legacy.id = 2
+    legacy.expires_at = None
+
+    lease_scheduler.load([legacy, reserved])
+
+    assert lease_scheduler.next_renewal() == now
+    lease_scheduler.cancel(1)
+    assert lease_scheduler.next_renewal() == now + dt.timedelta(seconds=100)
+
+def test_sweep_leases(loop, test_db, monkeypatch):
+    now = dt.datetime.now()
+    for i, seconds in enumerate((-10, 60, 7200)):
+        # expired, due within the margin, not due
+        test_db.add(SubInfo(
+            user_id=str(i), callback="http://callback/{}".format(i),
+            topic="http://topic/{}".format(i), lease_seconds=300,
+            date=now + dt.timedelta(seconds=seconds - 300)))
+
+    test_db.commit()
+    renewed = list()
+
+    async def update_sub(sub_info):
+        renewed.append(sub_info.user_id)
+        return True
+
+    monkeypatch.setattr(scheduler, "update_sub", update_sub)
+    monkeypatch.setattr(scheduler.lease, "scheduler", LeaseScheduler(margin=3600))
+
+    summary = loop.run_until_complete(scheduler.sweep_leases())
+
+    assert summary == {"renewed": 2, "failed": 0, "skipped": 0}
+    assert sorted(renewed) == ["0", "1"]
+
+def test_renew_legacy_secrets(loop, test_db, monkeypatch):
+    now = dt.datetime.now()
+    for i in range(2):
+        test_db.add(SubInfo(
+            user_id=str(i), callback="http://callback/{}".format(i),
+            topic="http://topic/{}".format(i), lease_seconds=300,
+            date=now - dt.timedelta(seconds=400)))
+
+    test_db.commit()
+    table = routing.RoutingTable()
+    table.load([], [], test_db.query(SubInfo).all())
+    posted = dict()
+
+    async def update_sub(sub_info):
+        session = db.Session()
+        stored = session.query(SubInfo).get(sub_info.id).secret
+        session.close()
+        # stored and accepted before the hub signs with it
+        assert stored == sub_info.secret
+        assert set(table.get_secrets(sub_info.user_id)) == {
+            None, sub_info.secret}
+        posted[sub_info.user_id] = sub_info.secret
+
+        return sub_info.user_id != "1"
+
+    def renew_subinfo(sub_info_list, session=None):
+        return False
+
+    monkeypatch.setattr(scheduler, "update_sub", update_sub)
+    monkeypatch.setattr(scheduler.routing, "table", table)
+    monkeypatch.setattr(scheduler.opers, "renew_subinfo", renew_subinfo)
+
+    summary = loop.run_until_complete(scheduler.update_job())
+
+    assert summary == {"renewed": 0, "failed": 2, "skipped": 0}
+    secrets = {sub.user_id: sub.secret for sub in test_db.query(SubInfo)}
+    # accepted by the hub, kept although its renewal was not recorded
+    assert secrets["0"] == posted["0"]
+    assert posted["0"] in table.get_secrets("0")
+    # refused by the hub, still unsigned
+    assert secrets["1"] is None
+    assert table.get_secrets("1") == [None]
@@ -0,0 +1,78 @@
+import os
+import sys
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import streamstate
+from lib.streamstate import StreamStateStore
+
+
+def stream(stream_id="1", title="title", game_id="21779"):
+    return {
+        "data": [{
+            "id": stream_id,
+            "user_id": "5678",
+            "game_id": game_id,
+            "title": title,
+            "started_at": "2017-12-01T10:09:45Z",
+        }],
+    }
+
+OFFLINE = {"data": []}
+
+def deliver(store, user_id, data):
+    event = store.classify(user_id, data)
+    store.record(user_id, data)
+
+    return event
+
+def test_classify():
+    store = StreamStateStore()
+    events = [
+        deliver(store, "5678", stream()),
+        deliver(store, "5678", stream()),
+        deliver(store, "5678", stream(title="new title")),
+        deliver(store, "5678", stream(title="new title", game_id="32399")),
+        deliver(store, "5678", OFFLINE),
+        deliver(store, "5678", OFFLINE),
+        deliver(store, "5678", stream(stream_id="2")),
+        deliver(store, "5678", stream(stream_id="3")),
+    ]
+
+    assert events == [
+        streamstate.ONLINE,
+        streamstate.DUPLICATE,
+        streamstate.UPDATE,
+        streamstate.UPDATE,
+        streamstate.OFFLINE,
+        streamstate.DUPLICATE,
+        streamstate.ONLINE,
+        streamstate.ONLINE,
+    ]
+    assert store.counts[streamstate.DUPLICATE] == 2
+
+def test_lru_eviction():
+    store = StreamStateStore(maxsize=2)
+    deliver(store, "1", stream())
+    deliver(store, "2", stream())
+    # touch 1, then evict 2
+    deliver(store, "1", stream())
+    deliver(store, "3", stream())
+
+    assert len(store) == 2
+    assert store.get("2") is None
+    assert deliver(store, "1", stream()) == streamstate.DUPLICATE
+    assert deliver(store, "2", stream()) == streamstate.ONLINE
+
+def test_record_after_delivery():
+    store = StreamStateStore()
+
+    # a go-live that failed to be delivered is not a duplicate
+    assert store.classify("5678", stream()) == streamstate.ONLINE
+    assert store.classify("5678", stream()) == streamstate.ONLINE
+    assert store.get("5678") is None
+
+    store.record("5678", stream())
+    assert store.classify("5678", stream()) == streamstate.DUPLICATE
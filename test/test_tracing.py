@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+
+import pytest
+
+src_path = os.path.realpath(__file__)
+src_dir = os.path.dirname(src_path)
+sys.path.append(os.path.join(src_dir, "../"))
+
+from lib import tracing
+from lib import worker
+from lib.setting import Setting
+
+
+setting = Setting.get_instance()
+setting.load_setting(os.path.join(src_dir, "../settings.json"))
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+@pytest.fixture
+def slow_log():
+    handler = ListHandler()
+    tracing.slow_logger.addHandler(handler)
+    yield handler.messages
+    tracing.slow_logger.removeHandler(handler)
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = tracing.Tracer(sample_rate=1.0, slow_seconds=0.05)
+    monkeypatch.setattr(tracing, "tracer", tracer)
+
+    return tracer
+
+def test_slow_trace(loop, tracer, slow_log):
+    @tracing.traced("embed")
+    async def build(name, *, delay):
+        with tracing.tracer.span("helix", endpoint="helix/games"):
+            await asyncio.sleep(delay)
+
+        return name
+
+    @tracing.traced_event("webhook")
+    async def handle(*, user_id):
+        with tracing.tracer.span("parse"):
+            pass
+
+        return await asyncio.gather(build("a", delay=0.06), build("b", delay=0.0))
+
+    assert loop.run_until_complete(handle(user_id="123")) == ["a", "b"]
+    assert tracer.stats() == {"sampled": 1, "slow": 1}
+    assert len(slow_log) == 1
+
+    lines = slow_log[0].splitlines()
+    assert lines[0].startswith("Slow webhook ")
+    assert lines[1].startswith("webhook +0.000s ")
+    assert lines[1].endswith(" user_id=123")
+    assert lines[2].startswith("  parse ")
+    assert [line.split()[0] for line in lines[3:]] == ["embed", "helix"] * 2
+    assert lines[4].startswith("    helix ") and lines[4].endswith(" endpoint=helix/games")
+
+    # fast traces are not logged
+    tracer.slow_seconds = 1.0
+    loop.run_until_complete(handle(user_id="123"))
+    assert tracer.stats() == {"sampled": 2, "slow": 1}
+    assert len(slow_log) == 1
+
+def test_unsampled(loop, tracer, slow_log):
+    tracer.sample_rate = 0.0
+
+    @tracing.traced_event("webhook")
+    async def handle():
+        with tracing.tracer.span("parse") as span:
+            return span
+
+    assert loop.run_until_complete(handle()) is None
+    assert tracer.stats() == {"sampled": 0, "slow": 0}
+
+def test_queued_trace(loop, tracer, slow_log):
+    processed = list()
+
+    async def handler(user_id):
+        with tracing.tracer.span("embed"):
+            await asyncio.sleep(0.06)
+
+        processed.append(user_id)
+
+    webhook_queue = worker.WebhookQueue(handler, workers=1)
+
+    @tracing.traced_event("webhook")
+    async def handle(*, user_id):
+        return webhook_queue.put(user_id)
+
+    async def test_coro():
+        webhook_queue.start()
+        assert await handle(user_id="123")
+        # the trace is still open while the event waits in the queue
+        assert tracer.stats()["slow"] == 0
+        await webhook_queue.drain()
+
+    loop.run_until_complete(test_coro())
+
+    assert processed == ["123"]
+    assert len(slow_log) == 1
+    assert [line.split()[0] for line in slow_log[0].splitlines()[1:]] == [
+        "webhook", "queue", "process", "embed"]
+
+def test_overhead(tracer):
+    tracer.sample_rate = 0.0
+    rounds = 100000
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        with tracer.trace("webhook"):
+            with tracer.span("parse"):
+                pass
+    per_event = (time.perf_counter() - start) / rounds
+
+    print("unsampled cost per event: {:.2f}us".format(per_event * 1e6))
+
+    assert per_event < 5e-6